@@ -0,0 +1,61 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class BatchLoader:
+    # Dataloader: load(key) calls made within `delay` of each other are merged into one call of
+    # load_batch(keys) -> {key: value}, at most max_batch keys each. A key asked for twice in one
+    # window is loaded once, a key missing from the result loads as None and an exception of the
+    # batch is raised to every caller in it.
+    def __init__(
+            self, load_batch: Callable[[list], Awaitable[dict]], max_batch: int = 100, delay: float = 0.005
+    ) -> None:
+        self.load_batch = load_batch
+        self.max_batch = max_batch
+        self.delay = delay
+        self.pending: dict = {}  # key -> future, for the next batch
+        self.timer: asyncio.TimerHandle = None
+        self.running: set = set()
+
+    async def load(self, key: Any) -> Any:
+        future = self.pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.pending[key] = loop.create_future()
+            if len(self.pending) >= self.max_batch:
+                self.dispatch()
+            elif self.timer is None:
+                self.timer = loop.call_later(self.delay, self.dispatch)
+        # shielded, a cancelled caller must not cancel the result for the others waiting for the key
+        return await asyncio.shield(future)
+
+    async def load_many(self, keys: list) -> list:
+        return await asyncio.gather(*(self.load(key) for key in keys))
+
+    def dispatch(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, {}
+        task = asyncio.create_task(self.run(batch))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def run(self, batch: dict) -> None:
+        try:
+            results = await self.load_batch(list(batch))
+        except BaseException as e:
+            # cancelled too (at shutdown), nobody may be left waiting for a batch that never comes
+            for future in batch.values():
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
@@ -0,0 +1,157 @@
+import asyncio
+import contextvars
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+from pydantic import BaseModel
+from disk_cache import DiskCache
+from resilience import REFRESH_BUDGET, deadline
+from scheduler import background
+from singleflight import SingleFlight
+
+
+# the encyclopedia changes only with game patches (the vehicle list itself lives in
+# encyclopedia.py), player statistics change only after their battles
+ENCYCLOPEDIA_TTL: float = 6 * 60 * 60
+PLAYER_TTL: float = 5 * 60
+TTLS: dict = {
+    "/encyclopedia/vehicleprofile/": ENCYCLOPEDIA_TTL,
+}
+# how long past its TTL an entry is still served while a fresh one is being loaded
+STALE_TTL: float = 24 * 60 * 60
+MAX_CACHE_BYTES: int = 64 * 1024 * 1024
+
+MISSING = object()
+
+
+class CacheEntry:
+    def __init__(self, value: Any, expires: float, stale_until: float, size: int) -> None:
+        self.value = value
+        self.expires = expires
+        self.stale_until = stale_until
+        self.size = size
+
+
+class TTLCache:
+    # Every entry lives for its own TTL, and the least recently used entries go first once all of
+    # them together exceed max_bytes. Only ever touched from the event loop, so no locking. With a
+    # store, a miss looks there before loading and whatever is loaded goes there too, so the other
+    # worker processes and the next start of the application find it ready.
+    # An expired entry is kept for STALE_TTL more: get_or_load returns it at once and loads the new
+    # value in the background, so a slow or broken API delays no page that was ever shown before.
+    def __init__(self, max_bytes: int = MAX_CACHE_BYTES, store: DiskCache = None) -> None:
+        self.max_bytes = max_bytes
+        self.store = store
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.loads = SingleFlight()
+        self.refreshes = SingleFlight()
+        self.running: set = set()
+
+    def get(self, key: tuple) -> Any:
+        entry = self.entries.get(key)
+        if entry is None or entry.expires <= time.monotonic():
+            if entry is not None and entry.stale_until <= time.monotonic():
+                self.remove(key)
+            self.misses += 1
+            return MISSING
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def set(self, key: tuple, value: Any, ttl: float) -> None:
+        # a negative ttl stores an already stale value
+        size = approximate_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.remove(key)
+        expires = time.monotonic() + ttl
+        self.entries[key] = CacheEntry(value, expires, expires + STALE_TTL, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key: tuple) -> None:
+        self.size -= self.entries.pop(key).size
+
+    async def get_or_load(self, key: tuple, ttl: float, load: Callable[[], Awaitable[Any]]) -> Any:
+        # concurrent misses of one key share a single load, a failed load raises and caches nothing
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if entry is not None and entry.expires > now:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+        if entry is not None and entry.stale_until > now:
+            self.entries.move_to_end(key)
+            self.stale_hits += 1
+            self.revalidate(key, ttl, load)
+            return entry.value
+        if entry is not None:
+            self.remove(key)
+        self.misses += 1
+        return await self.loads.do(key, lambda: self.load(key, ttl, load))
+
+    async def load(self, key: tuple, ttl: float, load: Callable[[], Awaitable[Any]]) -> Any:
+        if self.store is not None:
+            stored = await self.store.get(key)
+            if stored is not None:
+                value, expires = stored
+                self.set(key, value, expires - time.time())
+                if expires <= time.time():
+                    self.revalidate(key, ttl, load)
+                return value
+        return await self.refresh(key, ttl, load)
+
+    async def refresh(self, key: tuple, ttl: float, load: Callable[[], Awaitable[Any]]) -> Any:
+        value = await load()
+        self.set(key, value, ttl)
+        if self.store is not None:
+            await self.store.set(key, value, time.time() + ttl)
+        return value
+
+    def revalidate(self, key: tuple, ttl: float, load: Callable[[], Awaitable[Any]]) -> None:
+        # one background refresh per key at a time, a failed one leaves the stale value in place
+        if key in self.refreshes.calls:
+            return
+        # a fresh context: the request that found the stale entry is done before the refresh, its
+        # deadline and queue wait counter are not the refresh's
+        task = asyncio.create_task(self.refresh_in_background(key, ttl, load), context=contextvars.Context())
+        self.running.add(task)
+        task.add_done_callback(self.revalidated)
+
+    async def refresh_in_background(self, key: tuple, ttl: float, load: Callable[[], Awaitable[Any]]) -> None:
+        # the page was already answered with the stale value, its upstream calls wait for the others
+        with background(), deadline(REFRESH_BUDGET):
+            await self.refreshes.do(key, lambda: self.refresh(key, ttl, load))
+
+    def revalidated(self, task: asyncio.Task) -> None:
+        self.running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Background refresh failed: {task.exception()!r}")
+
+
+def approximate_size(value: Any) -> int:
+    # bytes taken by the value and everything it references, shared objects counted once
+    seen: set = set()
+    size = 0
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif isinstance(item, BaseModel):
+            stack.append(item.__dict__)
+    return size
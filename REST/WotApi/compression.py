@@ -0,0 +1,142 @@
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# smaller bodies are not worth the CPU, the headers alone are about this big
+MINIMUM_SIZE: int = 500
+COMPRESSIBLE_TYPES: tuple = (
+    "text/", "application/json", "application/x-ndjson", "application/javascript", "image/svg+xml"
+)
+GZIP_LEVEL: int = 6
+# brotli's fast levels compress better than gzip at about the same speed, its best ones are for
+# files compressed once, not for every response
+BROTLI_QUALITY: int = 5
+
+
+class CompressionMiddleware:
+    # Brotli (when installed) or gzip, whichever the client accepts, for pages, JSON and static
+    # files alike. Streamed responses are compressed chunk by chunk and every chunk is flushed, so
+    # an NDJSON line still reaches the client as soon as it is sent.
+    def __init__(self, app: ASGIApp, minimum_size: int = MINIMUM_SIZE) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await CompressedResponder(self.app, encoding, self.minimum_size)(scope, receive, send)
+
+
+class CompressedResponder:
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int) -> None:
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send: Send = None
+        self.start: Message = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            # held back until the first part of the body shows whether to compress
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            headers = MutableHeaders(scope=start)
+            if not self.worth_compressing(start["status"], headers, body, more_body):
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+            self.compressor = Compressor(self.encoding)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if "content-length" in headers:
+                del headers["Content-Length"]
+            etag = headers.get("etag")
+            if etag is not None and not etag.startswith("W/"):
+                headers["ETag"] = "W/" + etag
+            if not more_body:
+                body = self.compressor.finish(body)
+                headers["Content-Length"] = str(len(body))
+                await self.send(start)
+                await self.send({"type": "http.response.body", "body": body})
+                return
+            await self.send(start)
+
+        body = self.compressor.finish(body) if not more_body else self.compressor.flush(body)
+        await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    def worth_compressing(self, status: int, headers: MutableHeaders, body: bytes, more_body: bool) -> bool:
+        if status < 200 or status in (204, 206, 304) or "content-encoding" in headers:
+            return False
+        # a range is a part of the uncompressed file, compressing it would break the offsets
+        if "content-range" in headers:
+            return False
+        if not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES):
+            return False
+        # a whole body known to be small, or a file whose size says so
+        size = len(body) if not more_body else int(headers.get("content-length", self.minimum_size))
+        return size >= self.minimum_size
+
+
+class Compressor:
+    def __init__(self, encoding: str) -> None:
+        if encoding == "br":
+            self.brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self.brotli = None
+            self.gzip = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def flush(self, data: bytes) -> bytes:
+        if self.brotli is not None:
+            return self.brotli.process(data) + self.brotli.flush()
+        return self.gzip.compress(data) + self.gzip.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes) -> bytes:
+        if self.brotli is not None:
+            return self.brotli.process(data) + self.brotli.finish()
+        return self.gzip.compress(data) + self.gzip.flush()
+
+
+def choose_encoding(accept_encoding: str) -> str:
+    # "br" or "gzip", None when the client takes neither (q=0 refuses an encoding)
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", accepted.get("*", 0)) > 0:
+        return "gzip"
+    return None
@@ -0,0 +1,61 @@
+import hashlib
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import Request, Response
+from fastapi.staticfiles import StaticFiles
+
+
+# the browser keeps the pages but asks every time whether they are still good, which costs a 304
+# with no body as long as the encyclopedia stays the same
+PAGE_CACHE_CONTROL: str = "private, no-cache"
+STATIC_CACHE_CONTROL: str = "public, max-age=3600"
+
+
+def templates_tag(directory: str) -> str:
+    # a new deployment with changed templates must not be answered with a 304 for the old pages
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "rb") as f:
+            digest.update(name.encode() + f.read())
+    return digest.hexdigest()[:12]
+
+
+def validators(request: Request, version: int, tag: str) -> dict:
+    # a page is the same as long as the data version, the templates and the request are the same;
+    # weak, the body differs byte for byte once compressed
+    digest = hashlib.sha1(
+        f"{tag} {request.url.path} {sorted(request.query_params.multi_items())} "
+        f"{request.headers.get('accept', '')}".encode()
+    ).hexdigest()[:16]
+    return {
+        "ETag": f'W/"{version}-{digest}"',
+        "Last-Modified": formatdate(version, usegmt=True),
+        "Cache-Control": PAGE_CACHE_CONTROL,
+    }
+
+
+def not_modified(request: Request, headers: dict) -> Response:
+    # a 304 when the client already has this version, otherwise None; If-None-Match wins over
+    # If-Modified-Since when both are sent
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or headers["ETag"].removeprefix("W/") in tags:
+            return Response(status_code=304, headers=headers)
+        return None
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            if parsedate_to_datetime(headers["Last-Modified"]) <= parsedate_to_datetime(if_modified_since):
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+class CachedStaticFiles(StaticFiles):
+    # StaticFiles already answers conditional requests, this only lets the browser keep the files
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = STATIC_CACHE_CONTROL
+        return response
@@ -0,0 +1,91 @@
+import asyncio
+import pickle
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+CACHE_PATH: str = "cache.sqlite3"
+# how long a worker waits for another one that is writing at the moment
+BUSY_TIMEOUT: float = 5.0
+
+
+class DiskCache:
+    # Entries kept in a SQLite file shared by every worker process and surviving restarts. WAL mode
+    # lets the workers read while one of them writes. Expiry is wall clock time, the only clock all
+    # the processes agree on. The file is only touched from a thread of its own, so the event loop
+    # never waits for the disk, and a broken or locked file is a miss, never an error. Rows are
+    # kept for `grace` seconds past their expiry, get returns them and the caller decides.
+    def __init__(self, path: str = CACHE_PATH, grace: float = 0) -> None:
+        self.path = path
+        self.grace = grace
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk-cache")
+        self.connection: sqlite3.Connection = None
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: tuple) -> tuple:
+        # (value, expires) or None
+        found = await self.run(self.read, key)
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return found
+
+    async def set(self, key: tuple, value: Any, expires: float) -> None:
+        await self.run(self.write, key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires)
+
+    async def prune(self) -> None:
+        await self.run(self.delete_expired)
+
+    async def close(self) -> None:
+        await self.run(self.disconnect)
+        self.executor.shutdown()
+
+    async def run(self, call: Callable, *args) -> Any:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call, *args)
+        except sqlite3.Error as e:
+            print(f"Disk cache error: {e!r}")
+            return None
+
+    # everything below runs on the executor thread
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+            self.connection = connection
+        return self.connection
+
+    def disconnect(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def read(self, key: tuple) -> tuple:
+        row = self.connect().execute(
+            "SELECT value, expires FROM entries WHERE key = ? AND expires > ?", (repr(key), time.time() - self.grace)
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0]), row[1]
+        except Exception:
+            # written by an older version of the models, load it again
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (repr(key),))
+            return None
+
+    def write(self, key: tuple, value: bytes, expires: float) -> None:
+        self.connect().execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)", (repr(key), value, expires)
+        )
+
+    def delete_expired(self) -> None:
+        self.connect().execute("DELETE FROM entries WHERE expires <= ?", (time.time() - self.grace,))
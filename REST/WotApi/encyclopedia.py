@@ -0,0 +1,112 @@
+import asyncio
+import datetime
+import itertools
+import time
+import httpx
+from disk_cache import DiskCache
+from scheduler import background
+from models import Tank
+from services import tanks_list_service
+from wg_api import WgApi, WgApiException
+
+
+# the game version check is one small call, the vehicles are downloaded again only when it changed
+REFRESH_INTERVAL: float = 60 * 60
+RETRY_INTERVAL: float = 60
+VEHICLE_FIELDS: str = "tank_id,name,type,nation,tier,images.big_icon,description"
+# the saved snapshot is only replaced by a newer one, it is kept even when the API is down for long
+SNAPSHOT_TTL: float = 30 * 24 * 60 * 60
+SNAPSHOT_KEY: tuple = ("encyclopedia",)
+
+
+class Encyclopedia:
+    # Every vehicle of the game, downloaded in bulk and indexed by every combination of the
+    # tanks-list filters: index[(nation, tier, type)], with None for "any", is the answer to that
+    # form, ready made. A refresh builds new indexes and swaps them in at once, so a request never
+    # sees half of the old data and half of the new. With a store, every downloaded version is
+    # saved there, and the other workers and the next start load it from the disk instead.
+    def __init__(self, store: DiskCache = None) -> None:
+        self.store = store
+        self.tanks: dict = {}  # tank id -> Tank
+        self.index: dict = {}
+        self.version: int = None  # tanks_updated_at of the loaded data
+        self.updated_at: datetime.datetime = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.version is not None
+
+    def load(self, tanks: list[Tank], version: int) -> None:
+        tanks_by_id = {}
+        index = {}
+        for tank in tanks:
+            tanks_by_id[tank.tank_id] = tank
+            for key in itertools.product((tank.nation, None), (tank.tier, None), (tank.tank_type, None)):
+                index.setdefault(key, []).append(tank)
+        self.tanks, self.index, self.version = tanks_by_id, index, version
+        self.updated_at = datetime.datetime.fromtimestamp(version, datetime.timezone.utc)
+
+    def filter(self, nation: str = None, tier: int = None, tank_type: str = None) -> list[Tank]:
+        return self.index.get((nation, tier, tank_type), [])
+
+    def get(self, tank_id: int) -> Tank:
+        return self.tanks.get(tank_id)
+
+    async def refresh(self, api: WgApi) -> bool:
+        async with self.lock:
+            info = await api.get("/encyclopedia/info/", fields="tanks_updated_at")
+            version = info["tanks_updated_at"]
+            if version == self.version:
+                return False
+            snapshot = await self.saved()
+            if snapshot is not None and snapshot[0] == version:
+                self.load(snapshot[1], version)
+                print(f"Encyclopedia restored: {len(self.tanks)} vehicles, updated at {self.updated_at:%Y-%m-%d %H:%M}.")
+                return True
+            data = await api.get_all_pages("/encyclopedia/vehicles/", fields=VEHICLE_FIELDS)
+            tanks = tanks_list_service(data)
+            self.load(tanks, version)
+            print(f"Encyclopedia loaded: {len(self.tanks)} vehicles, updated at {self.updated_at:%Y-%m-%d %H:%M}.")
+            if self.store is not None:
+                await self.store.set(SNAPSHOT_KEY, (version, tanks), time.time() + SNAPSHOT_TTL)
+            return True
+
+    async def restore(self) -> bool:
+        # the last saved version, to serve before (or without) the first successful refresh
+        snapshot = await self.saved()
+        if snapshot is None:
+            return False
+        self.load(snapshot[1], snapshot[0])
+        print(f"Encyclopedia restored: {len(self.tanks)} vehicles, updated at {self.updated_at:%Y-%m-%d %H:%M}.")
+        return True
+
+    async def saved(self) -> tuple:
+        # (version, tanks) or None
+        if self.store is None:
+            return None
+        stored = await self.store.get(SNAPSHOT_KEY)
+        return None if stored is None else stored[0]
+
+    async def ensure_loaded(self, api: WgApi) -> None:
+        # the startup load failed and the next retry is not due yet, so this request loads it
+        if not self.loaded:
+            await self.refresh(api)
+
+
+async def try_refresh(encyclopedia: Encyclopedia, api: WgApi) -> bool:
+    try:
+        await encyclopedia.refresh(api)
+        return True
+    except (httpx.HTTPError, WgApiException, KeyError) as e:
+        print(f"Encyclopedia refresh failed: {e!r}")
+        return False
+
+
+async def keep_fresh(encyclopedia: Encyclopedia, api: WgApi) -> None:
+    # runs for the whole life of the application, behind the calls of the requests
+    delay = REFRESH_INTERVAL if encyclopedia.loaded else RETRY_INTERVAL
+    with background():
+        while True:
+            await asyncio.sleep(delay)
+            delay = REFRESH_INTERVAL if await try_refresh(encyclopedia, api) else RETRY_INTERVAL
@@ -1,13 +1,25 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Form, Depends, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_login import LoginManager
-from models import Player, Tank, TankDetails
-from services import player_stats_service, player_id_service, tanks_list_service, tank_details_service
+from compression import CompressionMiddleware
+from conditional import CachedStaticFiles, not_modified, templates_tag, validators
+from cache import TTLCache, ENCYCLOPEDIA_TTL, PLAYER_TTL, STALE_TTL
+from disk_cache import DiskCache
+from encyclopedia import Encyclopedia, keep_fresh, try_refresh
+from models import Player, RankedPlayer, Tank, TankDetails
+from players import PlayerLoader
+from resilience import deadline
+from scheduler import request_queue_wait
+from serialization import FieldSelectionException, json_response, ndjson_response, parse_fields
+from services import player_stats_service, ranking_service, tank_details_service
+from wg_api import WgApi, WgApiException, create_http_client
 from typing import Annotated
 import json
+import re
 import uvicorn
 import httpx
 
@@ -19,14 +31,43 @@ DB = {
     }
 }
 
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
-
 with open("api_token.json") as f:
     wot_api_key = json.load(f)['wgApi']
 
-WOT_BASE_URL: str = "https://api.worldoftanks.eu/wot"
+FACT_URL: str = "https://uselessfacts.jsph.pl/api/v2/facts/random"
+MAX_COMPARED_PLAYERS: int = 100
+MAX_RANKED_PLAYERS: int = 1000
+# routes under it answer with JSON, errors included
+API_PREFIX: str = "/api/"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # every upstream call of every request shares this client and its pool of open connections
+    async with create_http_client() as client:
+        app.state.http_client = client
+        # shared by all the worker processes and kept between restarts, the in-memory cache in
+        # front of it is per process
+        app.state.disk_cache = DiskCache(grace=STALE_TTL)
+        await app.state.disk_cache.prune()
+        app.state.cache = TTLCache(store=app.state.disk_cache)
+        app.state.wg_api = WgApi(client, wot_api_key, app.state.cache)
+        app.state.players = PlayerLoader(app.state.wg_api)
+        # the vehicle list is loaded before the first request and kept fresh in the background
+        app.state.encyclopedia = Encyclopedia(app.state.disk_cache)
+        await app.state.encyclopedia.restore()
+        await try_refresh(app.state.encyclopedia, app.state.wg_api)
+        refresher = asyncio.create_task(keep_fresh(app.state.encyclopedia, app.state.wg_api))
+        yield
+        refresher.cancel()
+        await app.state.disk_cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CompressionMiddleware)
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
+templates = Jinja2Templates(directory="templates")
+TEMPLATES_TAG: str = templates_tag("templates")
 
 
 class NotAuthenticatedException(Exception):
@@ -48,7 +89,7 @@ class PlayerNotFoundException(Exception):
         self.name = name
 
 
-class WgApiException(Exception):
+class TankNotFoundException(Exception):
     def __init__(self, name: str) -> None:
         self.name = name
 
@@ -58,13 +99,35 @@ class WgApiMissingDataException(Exception):
         self.name = name
 
 
+@app.middleware("http")
+async def upstream_budget(request: Request, call_next):
+    # every upstream call of the request shares this budget, so a slow API can't hold a page for long,
+    # and the time they spent queued for the rate limit is reported in the Server-Timing header
+    queue_wait = [0.0, 0]
+    token = request_queue_wait.set(queue_wait)
+    try:
+        with deadline():
+            response = await call_next(request)
+    finally:
+        request_queue_wait.reset(token)
+    if queue_wait[1]:
+        response.headers["Server-Timing"] = f'upstream-queue;dur={queue_wait[0] * 1000:.1f};desc="{queue_wait[1]} calls"'
+    return response
+
+
 login_manager = LoginManager(
     SECRET, token_url="/login", use_cookie=True, cookie_name="cookie-name", not_authenticated_exception=NotAuthenticatedException
 )
 
 
+def is_api(request: Request) -> bool:
+    return request.url.path.startswith(API_PREFIX)
+
+
 @app.exception_handler(NotAuthenticatedException)
 async def auth_exception_handler(request: Request, exc: NotAuthenticatedException):
+    if is_api(request):
+        return json_response({"error": "You have to sign in first."}, status_code=401)
     return templates.TemplateResponse("login_error.html", {"request": request, "error": "You have to sign in first."})
 
 
@@ -80,31 +143,92 @@ async def wrong_password_handler(request: Request, exc: WrongPasswordException):
 
 @app.exception_handler(PlayerNotFoundException)
 async def player_not_found_handler(request: Request, exc: PlayerNotFoundException):
+    if is_api(request):
+        return json_response({"error": str(exc)}, status_code=404)
+    return templates.TemplateResponse("error.html", {"request": request, "error": str(exc)})
+
+
+@app.exception_handler(TankNotFoundException)
+async def tank_not_found_handler(request: Request, exc: TankNotFoundException):
+    if is_api(request):
+        return json_response({"error": str(exc)}, status_code=404)
     return templates.TemplateResponse("error.html", {"request": request, "error": str(exc)})
 
 
+@app.exception_handler(FieldSelectionException)
+async def field_selection_handler(request: Request, exc: FieldSelectionException):
+    return json_response({"error": str(exc)}, status_code=400)
+
+
 @app.exception_handler(httpx.ConnectError)
 async def connection_error(request: Request, exc: httpx.ConnectError):
     message: str = "Connection error - could not connect to the server."
+    if is_api(request):
+        return json_response({"error": message}, status_code=502)
     return templates.TemplateResponse("error.html", {"request": request, "error": message})
 
 
 @app.exception_handler(httpx.ConnectTimeout)
 async def connection_timeout(request: Request, exc: httpx.ConnectTimeout):
     message: str = "Connection timeout - exceeded connection to the server time limit."
+    if is_api(request):
+        return json_response({"error": message}, status_code=504)
     return templates.TemplateResponse("error.html", {"request": request, "message": message})
 
 
 @app.exception_handler(WgApiException)
 async def wg_api_exception(request: Request, exc: WgApiException):
+    if is_api(request):
+        return json_response({"error": str(exc)}, status_code=502)
     return templates.TemplateResponse("error.html", {"request": request, "error": str(exc)})
 
 
 @app.exception_handler(WgApiMissingDataException)
 async def wg_missing_data(request: Request, exc: WgApiMissingDataException):
+    if is_api(request):
+        return json_response({"error": str(exc)}, status_code=502)
     return templates.TemplateResponse("error.html", {"request": request, "error": str(exc)})
 
 
+def get_wg_api(request: Request) -> WgApi:
+    return request.app.state.wg_api
+
+
+def get_cache(request: Request) -> TTLCache:
+    return request.app.state.cache
+
+
+def get_encyclopedia(request: Request) -> Encyclopedia:
+    return request.app.state.encyclopedia
+
+
+def get_players(request: Request) -> PlayerLoader:
+    return request.app.state.players
+
+
+def split_nicknames(nicknames: str) -> list[str]:
+    # comma or whitespace separated, every nickname once and in the given order
+    return list(dict.fromkeys(name for name in re.split(r"[\s,]+", nicknames) if name))
+
+
+async def load_player(players: PlayerLoader, cache: TTLCache, nickname: str) -> Player:
+    return await cache.get_or_load(("player", nickname), PLAYER_TTL, lambda: fetch_player(players, nickname))
+
+
+async def fetch_player(players: PlayerLoader, nickname: str) -> Player:
+    # both lookups go through the batch loaders, merged with those of the other requests in flight
+    try:
+        player_id = await players.find_id(nickname)
+        if player_id is None:
+            raise PlayerNotFoundException("Player with such nickname not found: " + nickname)
+        player_data = await players.info(player_id)
+        if player_data is None:
+            raise WgApiMissingDataException("Some data missing in WG database.")
+        return player_stats_service(player_data)
+    except KeyError:
+        raise WgApiMissingDataException("Some data missing in WG database.")
+
+
 @login_manager.user_loader()
 def load_user(username: str):
     user = DB.get(username)
@@ -140,49 +264,82 @@ async def root(request: Request, _=Depends(login_manager)):
 
 @app.post("/main/", response_class=HTMLResponse)
 async def root_fact(request: Request, _=Depends(login_manager)):
-    fact_url = "https://uselessfacts.jsph.pl/api/v2/facts/random"
-    async with httpx.AsyncClient() as client:
-        fact_response = await client.get(url=fact_url)
+    fact_response = await request.app.state.http_client.get(url=FACT_URL)
 
     random_fact = fact_response.json()["text"]
     return templates.TemplateResponse("index.html", {"request": request, "random_fact": random_fact})
 
 
 @app.post("/main/player/", response_class=HTMLResponse)
-async def player_statistics(nickname: Annotated[str, Form()], request: Request, _=Depends(login_manager)):
-    id_url: str = f"{WOT_BASE_URL}/account/list/?application_id={wot_api_key}&search={nickname}"
-    async with httpx.AsyncClient() as client:
-        id_response = await client.get(url=id_url)
-
-    data = id_response.json()
-    if data["status"] != "ok":
-        raise WgApiException(data["error"]["message"])
-
-    data = data["data"]
-    if len(data) < 1:
-        raise PlayerNotFoundException("Player with such nickname not found: " + nickname)
-
-    try:
-        player_id: int = player_id_service(data, nickname)
-    except KeyError:
-        raise WgApiMissingDataException("Some data missing in WG database.")
-
-    if player_id == -1:
-        raise PlayerNotFoundException("Player with such nickname not found: " + nickname)
-
-    data_url: str = f"{WOT_BASE_URL}/account/info/?application_id={wot_api_key}&account_id={player_id}"
-    async with httpx.AsyncClient() as client:
-        player_response = await client.get(url=data_url)
+async def player_statistics(
+        nickname: Annotated[str, Form()],
+        request: Request,
+        players: PlayerLoader = Depends(get_players),
+        cache: TTLCache = Depends(get_cache),
+        _=Depends(login_manager)
+):
+    player_data: Player = await load_player(players, cache, nickname)
+    return templates.TemplateResponse("player_stats.html", {"request": request, "player_data": player_data})
 
-    player_data = player_response.json()
-    if player_data["status"] != "ok":
-        raise WgApiException(player_data["error"]["message"])
 
+@app.post("/main/players/", response_class=HTMLResponse)
+async def players_comparison(
+        nicknames: Annotated[str, Form()],
+        request: Request,
+        players: PlayerLoader = Depends(get_players),
+        cache: TTLCache = Depends(get_cache),
+        _=Depends(login_manager)
+):
+    nicknames: list[str] = split_nicknames(nicknames)
+    if not nicknames:
+        raise PlayerNotFoundException("No nicknames given.")
+    if len(nicknames) > MAX_COMPARED_PLAYERS:
+        message = f"At most {MAX_COMPARED_PLAYERS} players can be compared at once."
+        return templates.TemplateResponse("error.html", {"request": request, "error": message})
+
+    # all of them at once, so the loaders send them upstream in one /account/list/ and one
+    # /account/info/ call
+    results = await asyncio.gather(*(load_player(players, cache, nickname) for nickname in nicknames), return_exceptions=True)
+    found: list[Player] = []
+    not_found: list[str] = []
+    for nickname, result in zip(nicknames, results):
+        if isinstance(result, PlayerNotFoundException):
+            not_found.append(nickname)
+        elif isinstance(result, Exception):
+            raise result
+        else:
+            found.append(result)
+    return templates.TemplateResponse(
+        "players_compare.html", {"request": request, "players": found, "not_found": not_found}
+    )
+
+
+@app.post("/main/ranking/", response_class=HTMLResponse)
+async def players_ranking(
+        nicknames: Annotated[str, Form()],
+        request: Request,
+        players: PlayerLoader = Depends(get_players),
+        _=Depends(login_manager)
+):
+    nicknames: list[str] = split_nicknames(nicknames)
+    if not nicknames:
+        raise PlayerNotFoundException("No nicknames given.")
+    if len(nicknames) > MAX_RANKED_PLAYERS:
+        message = f"At most {MAX_RANKED_PLAYERS} players can be ranked at once."
+        return templates.TemplateResponse("error.html", {"request": request, "error": message})
+
+    # the loaders split them into calls of 100 players each, all sent at once
     try:
-        player_data: Player = player_stats_service(player_data["data"][str(player_id)])
+        player_ids = await players.find_ids_many(nicknames)
+        found_ids: list[int] = [player_id for player_id in player_ids if player_id is not None]
+        player_data: list[dict] = [data for data in await players.info_many(found_ids) if data is not None]
+        ranking: list[RankedPlayer] = ranking_service(player_data)
     except KeyError:
         raise WgApiMissingDataException("Some data missing in WG database.")
-    return templates.TemplateResponse("player_stats.html", {"request": request, "player_data": player_data})
+    not_found: list[str] = [nickname for nickname, player_id in zip(nicknames, player_ids) if player_id is None]
+    return templates.TemplateResponse(
+        "ranking.html", {"request": request, "ranking": ranking, "not_found": not_found}
+    )
 
 
 @app.post("/main/tanks_list/", response_class=HTMLResponse)
@@ -191,62 +348,161 @@ async def tanks_list(
         tier: Annotated[str, Form()],
         tank_type: Annotated[str, Form()],
         request: Request,
+        api: WgApi = Depends(get_wg_api),
+        encyclopedia: Encyclopedia = Depends(get_encyclopedia),
         _=Depends(login_manager)
 ):
-    url = f"{WOT_BASE_URL}/encyclopedia/vehicles/?application_id={wot_api_key}"
-
-    if nation != "none":
-        url += f"&nation={nation}"
-    if tier != "none":
-        url += f"&tier={tier}"
-    if tank_type != "none":
-        url += f"&type={tank_type}"
+    tanks: list[Tank] = await filter_tanks(api, encyclopedia, nation, tier, tank_type)
+    return templates.TemplateResponse("tanks_list.html", {"request": request, "tanks": tanks})
 
-    async with httpx.AsyncClient() as client:
-        tank_list_response = await client.get(url=url)
 
-    tanks_list_data = tank_list_response.json()
-    if tanks_list_data["status"] != "ok":
-        raise WgApiException(tanks_list_data["error"]["message"])
+@app.get("/main/tanks_list/", response_class=HTMLResponse)
+async def tanks_list_page(
+        request: Request,
+        api: WgApi = Depends(get_wg_api),
+        encyclopedia: Encyclopedia = Depends(get_encyclopedia),
+        nation: str = None,
+        tier: str = None,
+        tank_type: str = None,
+        _=Depends(login_manager)
+):
+    # the same list as the form post, but a GET the browser can revalidate with a 304
+    tanks: list[Tank] = await filter_tanks(api, encyclopedia, nation, tier, tank_type)
+    headers = encyclopedia_validators(request, encyclopedia)
+    response = not_modified(request, headers)
+    if response is None:
+        response = templates.TemplateResponse("tanks_list.html", {"request": request, "tanks": tanks})
+        response.headers.update(headers)
+    return response
 
-    tanks_list_data: dict = tanks_list_data["data"]
-    try:
-        tanks: list[Tank] = tanks_list_service(tanks_list_data)
-    except KeyError:
-        raise WgApiMissingDataException("Some data missing in WG database.")
 
-    return templates.TemplateResponse("tanks_list.html", {"request": request, "tanks": tanks})
+@app.get("/main/tanks_list/{tank_id}", response_class=HTMLResponse)
+async def tank_details_page(
+        tank_id: int,
+        request: Request,
+        api: WgApi = Depends(get_wg_api),
+        cache: TTLCache = Depends(get_cache),
+        encyclopedia: Encyclopedia = Depends(get_encyclopedia),
+        _=Depends(login_manager)
+):
+    await encyclopedia.ensure_loaded(api)
+    headers = encyclopedia_validators(request, encyclopedia)
+    response = not_modified(request, headers)
+    if response is None:
+        tank: TankDetails = await load_tank_details(api, cache, encyclopedia, tank_id)
+        response = templates.TemplateResponse("tank_details.html", {"request": request, "tank": tank})
+        response.headers.update(headers)
+    return response
 
 
 @app.post("/main/tanks_list/{tank_id}", response_class=HTMLResponse)
 async def tank_details(
         tank_id: int,
-        tank_name: Annotated[str, Form()],
-        tank_type: Annotated[str, Form()],
-        nation: Annotated[str, Form()],
-        tier: Annotated[int, Form()],
-        tank_img_url: Annotated[str, Form()],
-        description: Annotated[str, Form()],
         request: Request,
+        api: WgApi = Depends(get_wg_api),
+        cache: TTLCache = Depends(get_cache),
+        encyclopedia: Encyclopedia = Depends(get_encyclopedia),
         _=Depends(login_manager)
 ):
-    url: str = f"{WOT_BASE_URL}/encyclopedia/vehicleprofile/?application_id={wot_api_key}&tank_id={tank_id}"
-    async with httpx.AsyncClient() as client:
-        tank_details_response = await client.get(url=url)
+    tank: TankDetails = await load_tank_details(api, cache, encyclopedia, tank_id)
+    return templates.TemplateResponse("tank_details.html", {"request": request, "tank": tank})
 
-    tank_details_data = tank_details_response.json()
-    if tank_details_data["status"] != "ok":
-        raise WgApiException(tank_details_data["error"]["message"])
 
-    try:
-        tank_details_data: dict = tank_details_data["data"][str(tank_id)]
-        tank: TankDetails = tank_details_service(
-            tank_details_data, tank_name, tank_type, nation, tier, tank_img_url, description
-        )
-    except KeyError:
-        raise WgApiMissingDataException("Some data missing in WG database.")
+def encyclopedia_validators(request: Request, encyclopedia: Encyclopedia) -> dict:
+    # the tanks pages only change with the encyclopedia version
+    return validators(request, encyclopedia.version, TEMPLATES_TAG)
+
+
+async def filter_tanks(api: WgApi, encyclopedia: Encyclopedia, nation: str, tier: str, tank_type: str) -> list[Tank]:
+    # answered from the local snapshot, no upstream call; "none" or nothing matches any value
+    await encyclopedia.ensure_loaded(api)
+    return encyclopedia.filter(
+        None if not nation or nation == "none" else nation,
+        None if not tier or tier == "none" or not tier.isdigit() else int(tier),
+        None if not tank_type or tank_type == "none" else tank_type
+    )
+
+
+async def load_tank_details(api: WgApi, cache: TTLCache, encyclopedia: Encyclopedia, tank_id: int) -> TankDetails:
+    await encyclopedia.ensure_loaded(api)
+    vehicle: Tank = encyclopedia.get(tank_id)
+    if vehicle is None:
+        raise TankNotFoundException(f"Tank with such id not found: {tank_id}")
+
+    async def load_details() -> TankDetails:
+        tank_details_data = await api.get("/encyclopedia/vehicleprofile/", tank_id=tank_id)
+        try:
+            tank_details_data: dict = tank_details_data[str(tank_id)]
+            return tank_details_service(
+                tank_details_data, vehicle.name, vehicle.tank_type, vehicle.nation, vehicle.tier,
+                vehicle.tank_img_url, vehicle.description
+            )
+        except KeyError:
+            raise WgApiMissingDataException("Some data missing in WG database.")
+
+    key = ("tank_details", tank_id, encyclopedia.version)
+    return await cache.get_or_load(key, ENCYCLOPEDIA_TTL, load_details)
+
+
+# JSON API: the same data as the pages, for scripts and dashboards. `fields` picks the fields to
+# return ("name,tier,canon.caliber"), the tanks list comes as NDJSON, one tank per line, with
+# format=ndjson or "Accept: application/x-ndjson".
+
+@app.get("/api/players/{nickname}")
+async def player_statistics_json(
+        nickname: str,
+        players: PlayerLoader = Depends(get_players),
+        cache: TTLCache = Depends(get_cache),
+        fields: str = None,
+        _=Depends(login_manager)
+):
+    include = parse_fields(fields, Player)
+    return json_response(await load_player(players, cache, nickname), include)
 
-    return templates.TemplateResponse("tank_details.html", {"request": request, "tank": tank})
+
+@app.get("/api/tanks/")
+async def tanks_list_json(
+        request: Request,
+        api: WgApi = Depends(get_wg_api),
+        encyclopedia: Encyclopedia = Depends(get_encyclopedia),
+        nation: str = None,
+        tier: str = None,
+        tank_type: str = None,
+        fields: str = None,
+        format: str = None,
+        _=Depends(login_manager)
+):
+    include = parse_fields(fields, Tank)
+    tanks: list[Tank] = await filter_tanks(api, encyclopedia, nation, tier, tank_type)
+    headers = encyclopedia_validators(request, encyclopedia)
+    response = not_modified(request, headers)
+    if response is None:
+        if format == "ndjson" or (format is None and "application/x-ndjson" in request.headers.get("accept", "")):
+            response = ndjson_response(tanks, include)
+        else:
+            response = json_response(tanks, include)
+        response.headers.update(headers)
+    return response
+
+
+@app.get("/api/tanks/{tank_id}")
+async def tank_details_json(
+        tank_id: int,
+        request: Request,
+        api: WgApi = Depends(get_wg_api),
+        cache: TTLCache = Depends(get_cache),
+        encyclopedia: Encyclopedia = Depends(get_encyclopedia),
+        fields: str = None,
+        _=Depends(login_manager)
+):
+    include = parse_fields(fields, TankDetails)
+    await encyclopedia.ensure_loaded(api)
+    headers = encyclopedia_validators(request, encyclopedia)
+    response = not_modified(request, headers)
+    if response is None:
+        response = json_response(await load_tank_details(api, cache, encyclopedia, tank_id), include)
+        response.headers.update(headers)
+    return response
 
 
 if __name__ == "__main__":
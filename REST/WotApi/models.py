@@ -21,6 +21,15 @@ class Player(BaseModel):
     personal_rating: int
 
 
+class RankedPlayer(BaseModel):
+    position: int
+    nickname: str
+    battles: int
+    wins_percents: float
+    avg_dmg: float
+    personal_rating: int
+
+
 class Tank(BaseModel):
     tank_id: int = None
     name: str = None
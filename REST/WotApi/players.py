@@ -0,0 +1,45 @@
+import asyncio
+import re
+from batching import BatchLoader
+from services import player_id_service
+from wg_api import WgApi
+
+
+# /account/list/ and /account/info/ take up to 100 comma separated nicknames/ids per call
+MAX_PLAYERS_PER_CALL: int = 100
+BATCH_DELAY: float = 0.005
+NICKNAME = re.compile(r"[A-Za-z0-9_]{3,24}")
+
+
+class PlayerLoader:
+    # Nickname -> account id and account id -> account info lookups of all concurrent requests,
+    # merged into as few upstream calls as possible: whatever arrives within BATCH_DELAY goes
+    # out together. The keys are sorted, so the same batch is also the same (coalesced) call.
+    def __init__(self, api: WgApi) -> None:
+        self.api = api
+        self.ids = BatchLoader(self.find_ids, MAX_PLAYERS_PER_CALL, BATCH_DELAY)
+        self.infos = BatchLoader(self.fetch_infos, MAX_PLAYERS_PER_CALL, BATCH_DELAY)
+
+    async def find_id(self, nickname: str) -> int:
+        # None when there is no such player, a nickname that can't exist is not even looked up
+        if not NICKNAME.fullmatch(nickname):
+            return None
+        return await self.ids.load(nickname)
+
+    async def info(self, account_id: int) -> dict:
+        return await self.infos.load(account_id)
+
+    async def find_ids_many(self, nicknames: list[str]) -> list[int]:
+        return await asyncio.gather(*(self.find_id(nickname) for nickname in nicknames))
+
+    async def info_many(self, account_ids: list[int]) -> list[dict]:
+        return await self.infos.load_many(account_ids)
+
+    async def find_ids(self, nicknames: list[str]) -> dict:
+        players = await self.api.get("/account/list/", search=",".join(sorted(nicknames)), type="exact")
+        found = {nickname: player_id_service(players, nickname) for nickname in nicknames}
+        return {nickname: account_id for nickname, account_id in found.items() if account_id != -1}
+
+    async def fetch_infos(self, account_ids: list[int]) -> dict:
+        data = await self.api.get("/account/info/", account_id=",".join(map(str, sorted(account_ids))))
+        return {int(account_id): info for account_id, info in data.items()}
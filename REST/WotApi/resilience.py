@@ -0,0 +1,71 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# a call that takes longer is given up on, whatever httpx's own timeouts would allow
+CALL_TIMEOUT: float = 3.0
+# all the upstream calls of one request together
+REQUEST_BUDGET: float = 5.0
+# a background refresh of a stale cache entry, which queues behind the requests
+REFRESH_BUDGET: float = 30.0
+FAILURE_THRESHOLD: int = 5
+RESET_TIMEOUT: float = 30.0
+
+# monotonic time by which the current request has to be answered, None outside of requests
+request_deadline: ContextVar = ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def deadline(budget: float = REQUEST_BUDGET):
+    token = request_deadline.set(time.monotonic() + budget)
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+
+def time_left(limit: float = CALL_TIMEOUT) -> float:
+    # what the next call may take: the call limit, or less when the request is running out of time
+    end = request_deadline.get()
+    if end is None:
+        return limit
+    return min(limit, end - time.monotonic())
+
+
+class CircuitBreaker:
+    # Closed, calls go through and consecutive failures are counted. After failure_threshold of
+    # them it opens and calls are refused at once, without waiting for an API that is down. Every
+    # reset_timeout one trial call is let through: a success closes it again, a failure keeps it
+    # open. One per process, the workers find out about the API on their own.
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float = None
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            # the trial call, the next one comes after another reset_timeout
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def succeeded(self) -> None:
+        if self.opened_at is not None:
+            print("Circuit breaker closed, the API answers again.")
+        self.failures = 0
+        self.opened_at = None
+
+    def failed(self) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                print(f"Circuit breaker opened after {self.failures} failed calls.")
+            self.opened_at = time.monotonic()
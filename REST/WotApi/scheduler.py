@@ -0,0 +1,93 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# Wargaming allows this many requests per second for one application_id, shared by all the
+# worker processes (uvicorn takes the number of workers from WEB_CONCURRENCY too)
+QUOTA: float = 10.0
+WORKERS: int = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+INTERACTIVE: int = 0
+BACKGROUND: int = 1
+
+# page loads go first, refreshes nobody is waiting for go when there is nothing else to do
+request_priority: ContextVar = ContextVar("request_priority", default=INTERACTIVE)
+# the request's [time spent in the queue, number of calls], set by the upstream_budget middleware in main.py
+request_queue_wait: ContextVar = ContextVar("request_queue_wait", default=None)
+
+
+@contextmanager
+def background():
+    token = request_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class Scheduler:
+    # Token bucket: a token every 1/rate seconds, at most `burst` of them saved up, a call takes one.
+    # With burst 1 calls are at least 1/rate apart, so no second ever sees more than `rate` of them,
+    # however many requests come at once. The calls that have to wait are queued by priority and
+    # then by arrival, and a single timer hands out the tokens as they come.
+    def __init__(self, rate: float = QUOTA / WORKERS, burst: float = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.queue: list = []  # (priority, arrival number, queued at, future)
+        self.arrivals = itertools.count()
+        self.timer: asyncio.TimerHandle = None
+        self.calls = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self, priority: int = None) -> float:
+        # waits for a token, returns how long it took
+        if priority is None:
+            priority = request_priority.get()
+        self.refill()
+        if not self.queue and self.tokens >= 1:
+            self.tokens -= 1
+            return self.record(0.0)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.arrivals), time.monotonic(), future))
+        self.schedule()
+        return self.record(await future)
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def schedule(self) -> None:
+        if self.timer is None:
+            delay = max(0.0, (1 - self.tokens) / self.rate)
+            self.timer = asyncio.get_running_loop().call_later(delay, self.release)
+
+    def release(self) -> None:
+        self.timer = None
+        self.refill()
+        while self.queue and self.tokens >= 1:
+            _, _, queued_at, future = heapq.heappop(self.queue)
+            # a caller that gave up waiting doesn't use its token
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(time.monotonic() - queued_at)
+        if self.queue:
+            self.schedule()
+
+    def record(self, waited: float) -> float:
+        self.calls += 1
+        self.waited += waited
+        self.max_wait = max(self.max_wait, waited)
+        request_wait = request_queue_wait.get()
+        if request_wait is not None:
+            request_wait[0] += waited
+            request_wait[1] += 1
+        return waited
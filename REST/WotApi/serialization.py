@@ -0,0 +1,62 @@
+from typing import Any, AsyncIterator
+import orjson
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+
+# rows serialized per chunk of a streamed list
+NDJSON_CHUNK: int = 100
+
+
+class FieldSelectionException(Exception):
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+def parse_fields(fields: str, model: type[BaseModel]) -> dict:
+    # "name,tier,canon.caliber" -> {"name": True, "tier": True, "canon": {"caliber": True}}, the
+    # `include` of model_dump; None (everything) when no fields are given
+    if not fields:
+        return None
+    include: dict = {}
+    for field in fields.split(","):
+        field = field.strip()
+        if not field:
+            continue
+        level, current = include, model
+        names = field.split(".")
+        for depth, name in enumerate(names):
+            if current is None or name not in current.model_fields:
+                raise FieldSelectionException(f"Unknown field: {field}")
+            if depth == len(names) - 1:
+                level[name] = True
+                break
+            annotation = current.model_fields[name].annotation
+            current = annotation if isinstance(annotation, type) and issubclass(annotation, BaseModel) else None
+            if not isinstance(level.get(name), dict):
+                level[name] = {}
+            level = level[name]
+    return include
+
+
+def to_json(value: Any, include: dict = None) -> bytes:
+    if isinstance(value, BaseModel):
+        value = value.model_dump(include=include)
+    elif isinstance(value, list):
+        value = [item.model_dump(include=include) if isinstance(item, BaseModel) else item for item in value]
+    return orjson.dumps(value)
+
+
+def json_response(value: Any, include: dict = None, status_code: int = 200) -> Response:
+    return Response(to_json(value, include), status_code=status_code, media_type="application/json")
+
+
+def ndjson_response(items: list[BaseModel], include: dict = None) -> StreamingResponse:
+    # one JSON object per line, the first lines are on their way before the last ones are serialized
+    async def lines() -> AsyncIterator[bytes]:
+        for start in range(0, len(items), NDJSON_CHUNK):
+            yield b"".join(
+                orjson.dumps(item.model_dump(include=include)) + b"\n" for item in items[start:start + NDJSON_CHUNK]
+            )
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
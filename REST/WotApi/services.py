@@ -1,6 +1,7 @@
-from models import Player, Tank, TankDetails, Canon, BaseAmmo
+from models import Player, RankedPlayer, Tank, TankDetails, Canon, BaseAmmo
 from math import tanh, asinh, exp
 import datetime
+import numpy as np
 
 
 def player_id_service(players: list[dict], nickname: str) -> int:
@@ -55,6 +56,38 @@ def player_stats_service(data: dict) -> Player:
     )
 
 
+def ranking_service(players: list[dict]) -> list[RankedPlayer]:
+    # /account/info/ data of many players -> the players by personal rating, best first, every
+    # rating computed at once on whole columns
+    statistics: list[dict] = [player["statistics"]["all"] for player in players]
+    count = len(statistics)
+    battles = np.fromiter((s["battles"] for s in statistics), np.float64, count)
+    wins = np.fromiter((s["wins"] for s in statistics), np.float64, count)
+    survived = np.fromiter((s["survived_battles"] for s in statistics), np.float64, count)
+    damage = np.fromiter((s["damage_dealt"] for s in statistics), np.float64, count)
+    avg_xp = np.fromiter((s["battle_avg_xp"] for s in statistics), np.float64, count)
+    radio_assist = np.fromiter((s["avg_damage_assisted_radio"] for s in statistics), np.float64, count)
+    track_assist = np.fromiter((s["avg_damage_assisted_track"] for s in statistics), np.float64, count)
+
+    played = battles != 0
+    divisor = np.where(played, battles, 1)
+    ratings = calculate_personal_ratings(
+        battles, wins / divisor, survived / divisor, damage / divisor, avg_xp, radio_assist, track_assist
+    )
+
+    ranking: list[RankedPlayer] = []
+    for position, i in enumerate(np.argsort(-ratings, kind="stable"), 1):
+        ranking.append(RankedPlayer(
+            position=position,
+            nickname=players[i]["nickname"],
+            battles=int(battles[i]),
+            wins_percents=round(float(wins[i] / battles[i]), 2) if played[i] else 0.0,
+            avg_dmg=round(float(damage[i] / battles[i]), 2) if played[i] else 0.0,
+            personal_rating=int(ratings[i])
+        ))
+    return ranking
+
+
 def tanks_list_service(tanks_list: dict) -> list[Tank]:
     final_list: list[Tank] = []
     tank_keys: list[str] = list(tanks_list.keys())
@@ -160,3 +193,30 @@ def calculate_personal_rating(
     )
     return round(personal_rate)
 
+
+def calculate_personal_ratings(
+        battles: np.ndarray,
+        wins_ratio: np.ndarray,
+        survived_ratio: np.ndarray,
+        avg_dmg: np.ndarray,
+        avg_xp: np.ndarray,
+        radio_assist: np.ndarray,
+        track_assist: np.ndarray
+) -> np.ndarray:
+    # calculate_personal_rating for whole columns of players, 0 for those without battles;
+    # np.rint rounds halves to even just like round()
+    played = battles != 0
+    battles = np.where(played, battles, 1)
+    bc_factor_1 = 540 * (battles ** 0.37)
+    bc_factor_2 = 0.00163 * (battles ** (-0.37))
+    wins_factor = 3500 / (1 + np.exp(16 - 31 * wins_ratio))
+    survived_factor = 1400 / (1 * np.exp(8 - 27 * survived_ratio))
+    dmg_factor = 3700 * np.arcsinh(0.0006 * avg_dmg)
+    xp_factor = 3900 * np.arcsinh(0.0015 * avg_xp)
+    assist_factor_1 = 1.4 * radio_assist
+    assist_factor_2 = 1.1 * track_assist
+
+    personal_rate = bc_factor_1 * np.tanh(
+        bc_factor_2 * (wins_factor + survived_factor + dmg_factor + xp_factor + assist_factor_1 + assist_factor_2)
+    )
+    return np.where(played, np.rint(personal_rate), 0).astype(np.int64)
@@ -0,0 +1,36 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class SingleFlight:
+    # Concurrent callers asking for the same key share one call: the first one starts it, the others
+    # wait for its result (or its exception). A caller that gets cancelled stops waiting, the call
+    # itself goes on for the others and is cancelled only when nobody waits for it anymore. Nothing
+    # is remembered after the call ends, caching is somebody else's job.
+    def __init__(self) -> None:
+        self.calls: dict = {}  # key -> [task, number of waiting callers]
+
+    async def do(self, key: tuple, call: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self.calls.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(call())
+            flight = self.calls[key] = [task, 0]
+            task.add_done_callback(lambda done: self.finished(key, done))
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        except asyncio.CancelledError:
+            if not flight[0].done() and flight[1] == 1:
+                # a caller arriving from now on starts a new call instead of joining a cancelled one
+                del self.calls[key]
+                flight[0].cancel()
+            raise
+        finally:
+            flight[1] -= 1
+
+    def finished(self, key: tuple, task: asyncio.Task) -> None:
+        if self.calls.get(key, [None])[0] is task:
+            del self.calls[key]
+        # the exception went to the waiters, or there were none left to give it to
+        if not task.cancelled():
+            task.exception()
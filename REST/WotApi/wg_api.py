@@ -0,0 +1,111 @@
+import asyncio
+import math
+import httpx
+from cache import TTLCache, TTLS
+from resilience import CircuitBreaker, time_left
+from scheduler import Scheduler
+from singleflight import SingleFlight
+
+
+WOT_BASE_URL: str = "https://api.worldoftanks.eu/wot"
+
+# One client for the whole application: connections (with their TLS sessions) are pooled and kept
+# alive between requests, and HTTP/2 multiplexes concurrent requests to one host over a single connection.
+POOL_LIMITS: httpx.Limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0)
+TIMEOUT: httpx.Timeout = httpx.Timeout(10.0, connect=5.0)
+# the most entries the API returns per call on paged endpoints
+PAGE_SIZE: int = 100
+# another application with the same application_id can still use up the quota
+LIMIT_RETRIES: int = 2
+
+
+class WgApiException(Exception):
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+class WgApiUnavailableException(WgApiException):
+    pass
+
+
+def create_http_client(
+        limits: httpx.Limits = POOL_LIMITS, timeout: httpx.Timeout = TIMEOUT, http2: bool = True
+) -> httpx.AsyncClient:
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+
+
+class WgApi:
+    def __init__(
+            self, client: httpx.AsyncClient, application_id: str, cache: TTLCache = None, base_url: str = WOT_BASE_URL
+    ) -> None:
+        self.client = client
+        self.application_id = application_id
+        self.cache = cache
+        self.base_url = base_url
+        self.flights = SingleFlight()
+        self.breaker = CircuitBreaker()
+        # every call goes through it, the quota is per application_id
+        self.scheduler = Scheduler()
+
+    async def get(self, path: str, **params) -> dict:
+        # responses of the endpoints listed in cache.TTLS are served from the cache while fresh,
+        # identical calls in flight at the same time are made once and share the parsed response
+        key = ("response", path, tuple(sorted(params.items())))
+        ttl = TTLS.get(path)
+        if self.cache is None or ttl is None:
+            return await self.flights.do(key, lambda: self.fetch_data(path, params))
+        return await self.cache.get_or_load(key, ttl, lambda: self.fetch_data(path, params))
+
+    async def get_all_pages(self, path: str, page_size: int = PAGE_SIZE, **params) -> dict:
+        # the first page tells how many there are, the rest are fetched concurrently
+        first = await self.fetch(path, {**params, "limit": page_size, "page_no": 1})
+        pages = first["meta"].get("page_total") or 1
+        rest = await asyncio.gather(
+            *(self.fetch(path, {**params, "limit": page_size, "page_no": page}) for page in range(2, pages + 1))
+        )
+        data = dict(first["data"])
+        for page in rest:
+            data.update(page["data"])
+        return data
+
+    async def fetch_data(self, path: str, params: dict) -> dict:
+        return (await self.fetch(path, params))["data"]
+
+    async def fetch(self, path: str, params: dict) -> dict:
+        for attempt in range(LIMIT_RETRIES + 1):
+            data = await self.call(path, params)
+            if data["status"] == "ok":
+                return data
+            if data["error"]["message"] != "REQUEST_LIMIT_EXCEEDED" or attempt == LIMIT_RETRIES:
+                raise WgApiException(data["error"]["message"])
+
+    async def call(self, path: str, params: dict) -> dict:
+        # refused at once while the breaker is open, queued for the rate limit, and given up on when
+        # out of time
+        if not self.breaker.allow():
+            raise WgApiUnavailableException("Wargaming API is unavailable, try again in a moment.")
+        try:
+            # as long as the deadline allows, background work without one waits for its turn
+            async with asyncio.timeout(time_left(math.inf)):
+                await self.scheduler.acquire()
+        except TimeoutError:
+            raise WgApiUnavailableException("Too many requests to Wargaming API, try again in a moment.")
+        budget = time_left()
+        if budget <= 0:
+            raise WgApiUnavailableException("Wargaming API did not answer in time.")
+        try:
+            async with asyncio.timeout(budget):
+                response = await self.client.get(
+                    url=f"{self.base_url}{path}", params={"application_id": self.application_id, **params}
+                )
+        except TimeoutError:
+            self.breaker.failed()
+            raise WgApiUnavailableException("Wargaming API did not answer in time.")
+        except httpx.TransportError:
+            self.breaker.failed()
+            raise
+        if response.status_code >= 500:
+            self.breaker.failed()
+            raise WgApiUnavailableException(f"Wargaming API error: {response.status_code}.")
+        self.breaker.succeeded()
+        return response.json()
@@ -0,0 +1,441 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+import zlib
+from array import array
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client.client import ChatClient
+from common import fragments, protocol
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+PROCESS_ERRORS: tuple = (OSError, IndexError, ValueError) + ((psutil.Error,) if psutil is not None else ())
+
+
+SERVER_IP: str = '127.0.0.1'
+SERVER_PORT: int = 12345
+SERVER_SCRIPT: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server', 'server.py')
+CONNECT_CONCURRENCY: int = 200
+DRAIN_TIME: float = 2.0
+SAMPLE_INTERVAL: float = 0.5
+
+# every benchmark message is "B <sender> <seq> <monotonic ns> <padding><crc32 as 8 hex digits>"
+BENCH_PREFIX: bytes = b'B '
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.tcp_clients = 0
+        self.udp_clients = 0
+        self.elapsed = 0.0
+        self.tcp_sent = 0
+        self.tcp_received = 0
+        self.udp_sent = 0
+        self.udp_received = 0
+        self.mangled = 0
+        self.bytes_received = 0
+        self.connect_errors = 0
+        self.disconnects = 0
+        self.tcp_latency = array('q')
+        self.udp_latency = array('q')
+
+
+def make_message(sender: int, seq: int, size: int) -> bytes:
+    body = b'B %d %d %d ' % (sender, seq, time.monotonic_ns())
+    body += b'x' * max(0, size - len(body) - 8)
+    return body + b'%08x' % zlib.crc32(body)
+
+
+def check_message(stats: Stats, payload: bytes, latencies: array) -> bool:
+    if not payload.startswith(BENCH_PREFIX):
+        return False
+    body, crc = payload[:-8], payload[-8:]
+    if crc != b'%08x' % zlib.crc32(body):
+        stats.mangled += 1
+        return False
+    try:
+        sent_at = int(body.split(b' ', 4)[3])
+    except (IndexError, ValueError):
+        stats.mangled += 1
+        return False
+    latencies.append(time.monotonic_ns() - sent_at)
+    return True
+
+
+class TcpBenchClient(ChatClient):
+    # the chat client itself, only counting and checking what it receives
+    def __init__(self, index: int, addr: tuple, room: str, stats: Stats) -> None:
+        super().__init__(f'bench-{index}', addr, room, udp=False)
+        self.index = index
+        self.stats = stats
+
+    def on_message(self, seq: int, text: str) -> None:
+        payload = text.encode(protocol.FORMAT)
+        self.stats.bytes_received += protocol.HEADER.size + protocol.SEQUENCE.size + len(payload)
+        if check_message(self.stats, payload, self.stats.tcp_latency):
+            self.stats.tcp_received += 1
+
+    def on_system(self, text: str) -> None:
+        self.stats.bytes_received += protocol.HEADER.size + len(text)
+
+    def on_disconnect(self) -> None:
+        self.stats.disconnects += 1
+
+
+class UdpBenchClient(asyncio.DatagramProtocol):
+    def __init__(self, stats: Stats) -> None:
+        self.stats = stats
+        self.transport: asyncio.DatagramTransport = None
+        self.fragmenter = fragments.Fragmenter()
+        self.reassembler = fragments.Reassembler()
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        transport.sendto(b'UDP INIT')
+
+    def datagram_received(self, data: bytes, address: tuple) -> None:
+        self.stats.bytes_received += len(data)
+        message = self.reassembler.feed(data, address)
+        if message is not None and check_message(self.stats, message, self.stats.udp_latency):
+            self.stats.udp_received += 1
+
+    def send(self, message: bytes) -> None:
+        for datagram in self.fragmenter.split(message):
+            self.transport.sendto(datagram)
+
+    def error_received(self, exc: Exception) -> None:
+        pass
+
+
+def process_tree(pid: int) -> list:
+    if psutil is not None:
+        try:
+            parent = psutil.Process(pid)
+            return [parent.pid] + [p.pid for p in parent.children(recursive=True)]
+        except psutil.Error:
+            return []
+
+    parents = {}
+    for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+    tree = [pid]
+    for p in tree:
+        tree.extend(child for child, parent in parents.items() if parent == p)
+    return tree
+
+
+def resource_usage(pid: int) -> tuple:
+    # (rss bytes, cpu seconds) of the server and all its worker processes
+    rss, cpu = 0, 0.0
+    for p in process_tree(pid):
+        try:
+            if psutil is not None:
+                proc = psutil.Process(p)
+                times = proc.cpu_times()
+                rss += proc.memory_info().rss
+                cpu += times.user + times.system
+            else:
+                with open(f'/proc/{p}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                ticks = os.sysconf('SC_CLK_TCK')
+                cpu += (int(fields[11]) + int(fields[12])) / ticks
+                rss += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        except PROCESS_ERRORS:
+            pass
+    return rss, cpu
+
+
+def sample_server(pid: int, duration: float) -> list:
+    samples = []
+    deadline = time.monotonic() + duration
+    while True:
+        samples.append(resource_usage(pid))
+        if time.monotonic() + SAMPLE_INTERVAL > deadline:
+            return samples
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))] / 1e6
+
+
+def latency_summary(latencies: array) -> dict:
+    values = sorted(latencies)
+    return {
+        'p50_ms': percentile(values, 0.50),
+        'p99_ms': percentile(values, 0.99),
+        'p999_ms': percentile(values, 0.999),
+        'max_ms': values[-1] / 1e6 if values else 0.0,
+    }
+
+
+async def settle(stats: Stats, quiet: float = 0.5, limit: float = 60.0) -> None:
+    deadline = time.monotonic() + limit
+    last = -1
+    while stats.bytes_received != last and time.monotonic() < deadline:
+        last = stats.bytes_received
+        await asyncio.sleep(quiet)
+
+
+async def generate(args: argparse.Namespace, part: int, parts: int, barrier) -> dict:
+    addr = (args.host, args.port)
+    stats = Stats()
+    rng = random.Random(args.seed + part)
+    loop = asyncio.get_running_loop()
+
+    limiter = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    tcp_clients = [TcpBenchClient(i, addr, args.room, stats) for i in range(part, args.tcp_clients, parts)]
+
+    async def connect(client: TcpBenchClient) -> bool:
+        async with limiter:
+            try:
+                await client.connect()
+                return True
+            except OSError:
+                stats.connect_errors += 1
+                return False
+
+    connected = await asyncio.gather(*(connect(c) for c in tcp_clients))
+    tcp_clients = [c for c, ok in zip(tcp_clients, connected) if ok]
+
+    udp_clients = []
+    for _ in range(part, args.udp_clients, parts):
+        _, protocol_ = await loop.create_datagram_endpoint(lambda: UdpBenchClient(stats), remote_addr=addr)
+        udp_clients.append(protocol_)
+
+    # every join is announced to the whole room, wait until that storm is over before measuring
+    await settle(stats)
+    await asyncio.to_thread(barrier.wait)
+
+    # this process sends its share of the total rate, proportional to the senders it owns
+    if args.senders:
+        senders = args.senders // parts + (part < args.senders % parts)
+        share = senders / args.senders
+        tcp_senders, udp_senders = tcp_clients[:senders], udp_clients[:senders]
+    else:
+        share = 1 / parts
+        tcp_senders, udp_senders = tcp_clients, udp_clients
+    seq = 0
+    start = time.monotonic()
+    next_ping = start + protocol.HEARTBEAT_INTERVAL
+    interval = 1 / (args.rate * share) if args.rate and tcp_senders else 0.0
+    udp_interval = 1 / (args.udp_rate * share) if args.udp_rate and udp_senders else 0.0
+    next_tcp, next_udp = start, start
+
+    while True:
+        now = time.monotonic()
+        if now - start >= args.duration:
+            break
+        if interval and now >= next_tcp:
+            # catch up in bursts if the loop fell behind, the offered rate stays what was asked for
+            while next_tcp <= now:
+                sender = rng.choice(tcp_senders)
+                sender.send_frame(protocol.CHAT, make_message(sender.index, seq, args.size))
+                stats.tcp_sent += 1
+                seq += 1
+                next_tcp += interval
+        if udp_interval and now >= next_udp:
+            while next_udp <= now:
+                sender = rng.choice(udp_senders)
+                sender.send(make_message(-1, seq, min(args.size, fragments.MAX_MESSAGE_SIZE)))
+                stats.udp_sent += 1
+                seq += 1
+                next_udp += udp_interval
+        if now >= next_ping:
+            # TCP clients send their own heartbeat
+            for c in udp_clients:
+                c.transport.sendto(b'UDP INIT')
+            next_ping += protocol.HEARTBEAT_INTERVAL
+        await asyncio.sleep(min(interval or 0.01, udp_interval or 0.01, 0.01))
+    stats.elapsed = time.monotonic() - start
+
+    await asyncio.sleep(args.drain)
+    for c in tcp_clients:
+        await c.close()
+    for c in udp_clients:
+        c.transport.close()
+
+    stats.tcp_clients = len(tcp_clients)
+    stats.udp_clients = len(udp_clients)
+    return vars(stats)
+
+
+def run_part(args: argparse.Namespace, part: int, parts: int, barrier, results) -> None:
+    results.put(asyncio.run(generate(args, part, parts, barrier)))
+
+
+def run_load(args: argparse.Namespace, server_pid: int) -> dict:
+    # one Python process can only decode so many deliveries per second, so the simulated
+    # clients are spread over several generator processes and their counters merged here
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(args.processes + 1)
+    results = context.Queue()
+    workers = [
+        context.Process(target=run_part, args=(args, part, args.processes, barrier, results))
+        for part in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    barrier.wait()
+    samples = sample_server(server_pid, args.duration) if server_pid else []
+    parts = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    total = {key: sum(p[key] for p in parts) for key in parts[0] if not key.endswith('latency')}
+    tcp_latency, udp_latency = array('q'), array('q')
+    for p in parts:
+        tcp_latency.extend(p['tcp_latency'])
+        udp_latency.extend(p['udp_latency'])
+    elapsed = max(p['elapsed'] for p in parts)
+    tcp_expected = total['tcp_sent'] * max(0, total['tcp_clients'] - 1)
+    udp_expected = total['udp_sent'] * total['udp_clients']
+
+    result = {
+        'config': {k: v for k, v in vars(args).items() if k not in ('json', 'compare')},
+        'tcp_clients': total['tcp_clients'],
+        'udp_clients': total['udp_clients'],
+        'connect_errors': total['connect_errors'],
+        'disconnects': total['disconnects'],
+        'duration_s': elapsed,
+        'tcp_sent': total['tcp_sent'],
+        'tcp_delivered': total['tcp_received'],
+        'tcp_dropped': max(0, tcp_expected - total['tcp_received']),
+        'tcp_deliveries_per_s': total['tcp_received'] / elapsed,
+        'tcp_latency': latency_summary(tcp_latency),
+        'udp_sent': total['udp_sent'],
+        'udp_delivered': total['udp_received'],
+        'udp_dropped': max(0, udp_expected - total['udp_received']),
+        'udp_deliveries_per_s': total['udp_received'] / elapsed,
+        'udp_latency': latency_summary(udp_latency),
+        'mangled': total['mangled'],
+        'received_mb_per_s': total['bytes_received'] / elapsed / 1e6,
+    }
+    if len(samples) >= 2:
+        result['server_rss_max_mb'] = max(rss for rss, _ in samples) / 1e6
+        result['server_cpu_percent'] = 100 * (samples[-1][1] - samples[0][1]) / (SAMPLE_INTERVAL * (len(samples) - 1))
+    return result
+
+
+def start_server(args: argparse.Namespace) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, *args.spawn_server.split()],
+        cwd=os.path.dirname(SERVER_SCRIPT), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit("[BENCH] Server did not start listening in time.")
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def print_report(result: dict) -> None:
+    print(f"[BENCH] {result['tcp_clients']} TCP / {result['udp_clients']} UDP clients, "
+          f"{result['duration_s']:.1f}s, {result['connect_errors']} connect errors, "
+          f"{result['disconnects']} disconnects")
+    for kind in ('tcp', 'udp'):
+        latency = result[f'{kind}_latency']
+        print(f"[BENCH] {kind.upper()}: sent {result[f'{kind}_sent']}, delivered {result[f'{kind}_delivered']} "
+              f"({result[f'{kind}_deliveries_per_s']:.0f}/s), dropped {result[f'{kind}_dropped']}, "
+              f"latency p50 {latency['p50_ms']:.2f} ms, p99 {latency['p99_ms']:.2f} ms, "
+              f"p999 {latency['p999_ms']:.2f} ms")
+    print(f"[BENCH] mangled {result['mangled']}, received {result['received_mb_per_s']:.2f} MB/s")
+    if 'server_rss_max_mb' in result:
+        print(f"[BENCH] server RSS max {result['server_rss_max_mb']:.1f} MB, CPU {result['server_cpu_percent']:.0f}%")
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for key in ('tcp_deliveries_per_s', 'udp_deliveries_per_s'):
+        if baseline.get(key) and result[key] < baseline[key] * (1 - tolerance):
+            regressions.append(f"{key}: {result[key]:.0f} < baseline {baseline[key]:.0f}")
+    for kind in ('tcp', 'udp'):
+        old, new = baseline.get(f'{kind}_latency', {}).get('p99_ms'), result[f'{kind}_latency']['p99_ms']
+        if old and new > old * (1 + tolerance):
+            regressions.append(f"{kind}_latency p99: {new:.2f} ms > baseline {old:.2f} ms")
+    for key in ('mangled', 'tcp_dropped'):
+        if result[key] > baseline.get(key, 0):
+            regressions.append(f"{key}: {result[key]} > baseline {baseline.get(key, 0)}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Headless load generator for the chat server.")
+    parser.add_argument('--host', default=SERVER_IP)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--tcp-clients', type=int, default=1000)
+    parser.add_argument('--udp-clients', type=int, default=0)
+    parser.add_argument('--senders', type=int, default=10, help="clients that send, the rest only listen (0: all)")
+    parser.add_argument('--rate', type=float, default=50.0, help="TCP messages per second, all senders together")
+    parser.add_argument('--udp-rate', type=float, default=0.0, help="UDP messages per second, all senders together")
+    parser.add_argument('--size', type=int, default=128, help="message size in bytes")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of sending")
+    parser.add_argument('--drain', type=float, default=DRAIN_TIME, help="seconds to wait for stragglers")
+    parser.add_argument('--processes', type=int, default=1, help="generator processes to spread the clients over")
+    parser.add_argument('--room', help="room the TCP clients join, a fresh one per run by default (no history)")
+    parser.add_argument('--seed', type=int, default=1, help="seed for picking senders, fixed for repeatable runs")
+    parser.add_argument('--spawn-server', metavar='ARGS', help="start server.py with these arguments, e.g. '--mode threads'")
+    parser.add_argument('--server-pid', type=int, help="pid of an already running server to sample RSS/CPU of")
+    parser.add_argument('--json', metavar='FILE', help="write the results to FILE")
+    parser.add_argument('--compare', metavar='FILE', help="fail if results regressed against a previous --json FILE")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed relative regression (default: 0.1)")
+    args = parser.parse_args()
+    args.room = args.room or f'bench-{os.getpid()}'
+
+    server = start_server(args) if args.spawn_server is not None else None
+    server_pid = server.pid if server is not None else args.server_pid
+    try:
+        result = run_load(args, server_pid)
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"[BENCH] REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
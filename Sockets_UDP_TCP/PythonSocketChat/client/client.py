@@ -1,8 +1,15 @@
+import argparse
+import asyncio
+import os
 import socket
 import threading
 import struct
 import sys
+import time
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import compression, fragments, protocol, reliable
 
 SERVER_IP: str = '127.0.0.1'
 SERVER_PORT: int = 12345
@@ -11,11 +18,12 @@ ADDR: tuple = (SERVER_IP, SERVER_PORT)
 MULTICAST_GROUP: str = '224.0.0.224'
 MULTICAST_PORT: int = 12346
 MULTICAST_ADDR: tuple = (MULTICAST_GROUP, MULTICAST_PORT)
+MULTICAST_RECEIVE_BUFFER: int = 4 * 1024 * 1024
 
 FORMAT: str = 'utf-8'
-NICK: str = ''
+UDP_INIT: bytes = "UDP INIT".encode(FORMAT)
 
-ASCII_ART_UDP: str = """      
+ASCII_ART_UDP: str = """
       /`·.¸
      /¸...¸`:·
  ¸.·´  ¸   `·.¸.·´)
@@ -32,7 +40,7 @@ ASCII_ART_MULTICAST: str = """
   /  (#) (#)  \\
   \  /     \  /
    \ \_____/ /
-    \/  |  \/  
+    \/  |  \/
   _ | o | o | _
  | \|o  |  o|/ |
  |  |  o|o  |  |
@@ -45,101 +53,367 @@ ASCII_ART_MULTICAST: str = """
 """
 
 
-client: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-client_udp: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-client_multicast: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+def multicast_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # room for a burst of fragments, whatever overflows has to be recovered with NACKs
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MULTICAST_RECEIVE_BUFFER)
 
-def receive_tcp() -> None:
-    while True:
-        try:
-            message = client.recv(1024).decode(FORMAT)
-            if message == '#SERVER SHUTDOWN#':
-                print("[CLIENT] Server has been shutdown. Press enter key to leave.")
-                break
-            print(message)
-        except ConnectionAbortedError:
-            break
+    if sys.platform == "win32":
+        sock.bind(('', MULTICAST_PORT))
+    else:
+        sock.bind(MULTICAST_ADDR)
 
+    group = socket.inet_aton(MULTICAST_GROUP)
+    mreq = struct.pack('4sL', group, socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    return sock
 
-def receive_udp() -> None:
-    client_udp.sendto("UDP INIT".encode(FORMAT), ADDR)
 
-    while True:
+class DatagramReceiver(asyncio.DatagramProtocol):
+    def __init__(self, reassembler: fragments.Reassembler, on_message) -> None:
+        self.reassembler = reassembler
+        self.on_message = on_message
+
+    def datagram_received(self, data: bytes, address: tuple) -> None:
+        message = self.reassembler.feed(data, address)
+        if message is not None:
+            self.on_message(message)
+
+    def error_received(self, exc: Exception) -> None:
+        pass
+
+
+class MulticastReceiver(asyncio.DatagramProtocol):
+    def __init__(self, client: 'ChatClient') -> None:
+        self.client = client
+
+    def datagram_received(self, data: bytes, address: tuple) -> None:
+        self.client.multicast_received(data, address)
+
+    def error_received(self, exc: Exception) -> None:
+        pass
+
+
+# One chat connection driven by the caller's event loop: the framed TCP stream, the heartbeat and
+# optionally the UDP and multicast sockets, without a thread of its own. A bot subclasses it and
+# overrides the on_* hooks, thousands of instances can share one loop (keep multicast off for those,
+# every instance would join the group). It remembers its room and the last message number it saw,
+# so connect() after a lost connection resumes where the client left off.
+# With `compression` it asks the server to compress the TCP stream both ways and compresses what it
+# sends over UDP and multicast (every client understands compressed datagrams, asked for or not).
+class ChatClient:
+    def __init__(
+            self, nickname: str, addr: tuple = ADDR, room: str = None,
+            udp: bool = True, multicast: bool = False, heartbeat: bool = True, reliable_multicast: bool = True,
+            compression: bool = True
+    ) -> None:
+        self.nickname = nickname
+        self.addr = addr
+        self.room = room
+        self.last_seq: int = None
+        self.use_udp = udp
+        self.use_multicast = multicast
+        self.use_heartbeat = heartbeat
+        self.writer: asyncio.StreamWriter = None
+        self.udp: asyncio.DatagramTransport = None
+        self.multicast: asyncio.DatagramTransport = None
+        self.fragmenter = fragments.Fragmenter()
+        self.reassembler = fragments.Reassembler()
+        # multicast is received reliably from every sender, what we send is numbered only in this mode
+        self.reliable_multicast = reliable_multicast
+        self.reliable = reliable.ReliableMulticast(self.fragmenter.sender_id)
+        self.use_compression = compression
+        self.compress_tcp = False  # until the server agrees to it
+        self.tasks: list = []
+        self.closed: asyncio.Event = None
+
+    async def connect(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.writer is not None:
+            await self.close()  # reconnecting, drop what is left of the previous connection
+        reader, self.writer = await asyncio.open_connection(*self.addr)
+        self.closed = asyncio.Event()
+        self.compress_tcp = False
+
+        # an empty room means the lobby, an empty sequence number the whole history
+        fields = [self.nickname, self.room or '', '' if self.last_seq is None else str(self.last_seq)]
+        if self.use_compression:
+            fields.append(compression.CAPABILITY)
+        self.send_frame(protocol.NICKNAME, '\0'.join(fields).rstrip('\0').encode(FORMAT))
+
+        if self.use_udp:
+            # the server finds our room by the address, so UDP shares the local address of the TCP connection
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(self.writer.get_extra_info('sockname'))
+            self.udp, _ = await loop.create_datagram_endpoint(
+                lambda: DatagramReceiver(self.reassembler, self.udp_received), sock=sock
+            )
+            self.udp.sendto(UDP_INIT, self.addr)
+        if self.use_multicast:
+            self.multicast, _ = await loop.create_datagram_endpoint(
+                lambda: MulticastReceiver(self), sock=multicast_socket()
+            )
+
+        self.tasks = [asyncio.create_task(self.receive(reader))]
+        if self.use_heartbeat:
+            self.tasks.append(asyncio.create_task(self.heartbeat()))
+        if self.use_multicast:
+            self.tasks.append(asyncio.create_task(self.recover_multicast()))
+
+    async def receive(self, reader: asyncio.StreamReader) -> None:
+        decoder = protocol.FrameDecoder()
         try:
-            message, _ = client_udp.recvfrom(1024)
-            print(message.decode(FORMAT))
-        except (KeyboardInterrupt, OSError):
-            break
+            while True:
+                data = await reader.read(protocol.READ_CHUNK)
+                if not data:
+                    self.on_disconnect()
+                    break
+                for kind, payload in decoder.feed(data):
+                    if kind == protocol.MESSAGE:
+                        self.last_seq, text = protocol.decode_message(payload)
+                        self.on_message(self.last_seq, text.decode(FORMAT, errors='replace'))
+                    elif kind == protocol.SYSTEM:
+                        self.on_system(payload.decode(FORMAT, errors='replace'))
+                    elif kind == protocol.CAPABILITIES:
+                        accepted = payload.decode(FORMAT, errors='replace').split(',')
+                        self.compress_tcp = compression.CAPABILITY in accepted
+                    elif kind == protocol.SHUTDOWN:
+                        self.on_shutdown()
+                        return
+        except (ConnectionError, protocol.ProtocolError):
+            self.on_disconnect()
+        finally:
+            self.closed.set()
 
+    async def heartbeat(self) -> None:
+        # keeps both registrations alive on the server, it drops clients that stay silent
+        while True:
+            await asyncio.sleep(protocol.HEARTBEAT_INTERVAL)
+            self.send_frame(protocol.PING)
+            if self.udp is not None:
+                self.udp.sendto(UDP_INIT, self.addr)
 
-def receive_multicast() -> None:
-    while True:
+    def multicast_received(self, data: bytes, address: tuple) -> None:
+        if not reliable.is_reliable(data):
+            self.deliver_multicast(data, address)
+            return
+        ready, packets = self.reliable.receive(data, time.monotonic())
+        for packet in packets:
+            self.multicast.sendto(packet, MULTICAST_ADDR)
+        for _, datagram in ready:
+            self.deliver_multicast(datagram, None)
+
+    def deliver_multicast(self, datagram: bytes, source: tuple) -> None:
+        message = self.reassembler.feed(datagram, source)
+        if message is not None:
+            message = compression.unpack_message(message, fragments.MAX_MESSAGE_SIZE)
+        if message is not None:
+            self.on_multicast(message)
+
+    def udp_received(self, message: bytes) -> None:
+        message = compression.unpack_message(message, fragments.MAX_MESSAGE_SIZE)
+        if message is not None:
+            self.on_udp(message)
+
+    async def recover_multicast(self) -> None:
+        # NACKs for gaps, heartbeats for our own stream, and delivery past datagrams given up on
+        while True:
+            await asyncio.sleep(reliable.POLL_INTERVAL)
+            ready, packets = self.reliable.poll(time.monotonic())
+            for packet in packets:
+                self.multicast.sendto(packet, MULTICAST_ADDR)
+            for _, datagram in ready:
+                self.deliver_multicast(datagram, None)
+
+    def send_frame(self, kind: int, payload: bytes = b'') -> None:
+        if not self.writer.is_closing():
+            frame = protocol.encode_frame(kind, payload)
+            self.writer.write(protocol.compress_frames(frame) if self.compress_tcp else frame)
+
+    def send(self, text: str) -> None:
+        self.send_frame(protocol.CHAT, f'[{self.nickname}] {text}'.encode(FORMAT))
+
+    def pack_datagram_message(self, text: str) -> bytes:
+        # the limit is on the uncompressed message, that is what the receiver has to hold
+        message = f'[{self.nickname}]:\n{text}'.encode(FORMAT)
+        if len(message) > fragments.MAX_MESSAGE_SIZE:
+            raise ValueError(f"Message of {len(message)} bytes exceeds the {fragments.MAX_MESSAGE_SIZE} bytes limit.")
+        return compression.pack_message(message) if self.use_compression else message
+
+    def send_udp(self, text: str) -> None:
+        # up to fragments.MAX_MESSAGE_SIZE, split into datagrams that fit any link
+        if self.udp is None:
+            print("[CLIENT] UDP is disabled.")
+            return
+        for datagram in self.fragmenter.split(self.pack_datagram_message(text)):
+            self.udp.sendto(datagram, self.addr)
+
+    def send_multicast(self, text: str) -> None:
+        if self.multicast is None:
+            print("[CLIENT] Multicast is disabled.")
+            return
+        now = time.monotonic()
+        for datagram in self.fragmenter.split(self.pack_datagram_message(text)):
+            if self.reliable_multicast:
+                datagram = self.reliable.send(datagram, now)
+            self.multicast.sendto(datagram, MULTICAST_ADDR)
+
+    def join(self, room: str) -> None:
+        # numbers are per room, a new room starts from its whole history
+        self.room, self.last_seq = room, None
+        self.send_frame(protocol.ROOM_JOIN, room.encode(FORMAT))
+
+    def leave_room(self) -> None:
+        self.room, self.last_seq = None, None
+        self.send_frame(protocol.ROOM_LEAVE)
+
+    def list_rooms(self) -> None:
+        self.send_frame(protocol.ROOM_LIST)
+
+    async def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        for transport in (self.udp, self.multicast):
+            if transport is not None:
+                transport.close()
+        self.udp, self.multicast = None, None
+        self.writer.close()
         try:
-            message, _ = client_multicast.recvfrom(1024)
-            print(message.decode(FORMAT))
-        except (KeyboardInterrupt, OSError):
-            break
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
 
+    # hooks for subclasses, called on the event loop
+    def on_message(self, seq: int, text: str) -> None:
+        pass
 
-def main() -> None:
-    NICK = input("[CLIENT] Enter your nickname: ")
+    def on_system(self, text: str) -> None:
+        pass
 
-    try:
-        client.connect(ADDR)
-    except ConnectionRefusedError:
-        print("[CLIENT] Could not connect to the server.")
-        exit()
-    
-    client_udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    client_udp.bind(client.getsockname())
+    def on_udp(self, data: bytes) -> None:
+        pass
 
-    # settig up multicast socket
-    client_multicast.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    def on_multicast(self, data: bytes) -> None:
+        pass
 
-    if sys.platform == "win32":
-        client_multicast.bind(('', MULTICAST_PORT))
-    else:
-        client_multicast.bind(MULTICAST_ADDR)
+    def on_shutdown(self) -> None:
+        pass
 
-    group = socket.inet_aton(MULTICAST_GROUP)
-    mreq = struct.pack('4sL', group, socket.INADDR_ANY)
-    client_multicast.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    def on_disconnect(self) -> None:
+        pass
+
+
+class ConsoleClient(ChatClient):
+    def on_message(self, seq: int, text: str) -> None:
+        print(text)
+
+    def on_system(self, text: str) -> None:
+        print(text)
 
+    def on_udp(self, data: bytes) -> None:
+        print(data.decode(FORMAT, errors='replace'))
 
-    client.send(NICK.encode(FORMAT))
+    def on_multicast(self, data: bytes) -> None:
+        print(data.decode(FORMAT, errors='replace'))
 
-    receive_thread = threading.Thread(target=receive_tcp)
-    receive_thread.start()
+    def on_shutdown(self) -> None:
+        print("[CLIENT] Server has been shutdown.")
 
-    receive_udp_thread = threading.Thread(target=receive_udp)
-    receive_udp_thread.start()
+    def on_disconnect(self) -> None:
+        print("[CLIENT] Connection closed by the server.")
 
-    receive_multicast_thread = threading.Thread(target=receive_multicast)
-    receive_multicast_thread.start()
+
+def watch_stdin(queue: asyncio.Queue) -> None:
+    # every line goes to the queue, '' marks the end of input
+    loop = asyncio.get_running_loop()
+    fd = sys.stdin.fileno()
+    pending = bytearray()
+
+    def readable() -> None:
+        data = os.read(fd, 4096)
+        if not data:
+            loop.remove_reader(fd)
+            queue.put_nowait('')
+            return
+        pending.extend(data)
+        *lines, rest = pending.split(b'\n')
+        pending[:] = rest
+        for line in lines:
+            queue.put_nowait(line.decode(errors='replace') + '\n')
+
+    try:
+        loop.add_reader(fd, readable)
+    except (NotImplementedError, ValueError, OSError):
+        # Windows can't watch the console with select, a blocking reader thread feeds the loop instead
+        def read() -> None:
+            for line in iter(sys.stdin.readline, ''):
+                loop.call_soon_threadsafe(queue.put_nowait, line)
+            loop.call_soon_threadsafe(queue.put_nowait, '')
+
+        threading.Thread(target=read, daemon=True).start()
+
+
+async def run_console(addr: tuple = ADDR) -> None:
+    lines = asyncio.Queue()
+    watch_stdin(lines)
+    print("[CLIENT] Enter your nickname: ", end='', flush=True)
+    nickname = (await lines.get()).rstrip('\n')
+
+    client = ConsoleClient(nickname, addr, multicast=True)
+    try:
+        await client.connect()
+    except OSError:
+        print("[CLIENT] Could not connect to the server.")
+        return
+
+    closed = asyncio.create_task(client.closed.wait())
 
     while True:
-        try:
-            input_message = input("")
-
-            if input_message == 'Q':
-                print("[CLIENT] Disconnecting...")
-                break
-            elif input_message == 'U':
-                udp_msg = f'[{NICK}]:\n' + ASCII_ART_UDP
-                client_udp.sendto(udp_msg.encode(FORMAT), ADDR)
-            elif input_message == 'M':
-                multicast_msg = f'[{NICK}]:\n' + ASCII_ART_MULTICAST
-                client_multicast.sendto(multicast_msg.encode(FORMAT), MULTICAST_ADDR)
-            elif input_message:
-                input_message = f'[{NICK}] {input_message}'
-                client.send(input_message.encode(FORMAT))
-        except (KeyboardInterrupt, ConnectionResetError):
+        line = asyncio.create_task(lines.get())
+        await asyncio.wait({line, closed}, return_when=asyncio.FIRST_COMPLETED)
+        if not line.done():
+            line.cancel()
+            break
+
+        input_message = line.result()
+        if not input_message:  # end of input, like Q
+            print("[CLIENT] Disconnecting...")
+            break
+        input_message = input_message.rstrip('\n')
+        if input_message == 'Q':
             print("[CLIENT] Disconnecting...")
             break
+        elif input_message == 'U':
+            client.send_udp(ASCII_ART_UDP)
+        elif input_message == 'M':
+            client.send_multicast(ASCII_ART_MULTICAST)
+        elif input_message.startswith('/join '):
+            client.join(input_message[len('/join '):])
+        elif input_message == '/leave':
+            client.leave_room()
+        elif input_message == '/rooms':
+            client.list_rooms()
+        elif input_message:
+            client.send(input_message)
 
-    client_udp.close()
-    client_multicast.close()
-    client.close()
+    closed.cancel()
+    await client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="TCP/UDP chat client.")
+    parser.add_argument('--host', default=SERVER_IP, help="server address (default: %(default)s)")
+    parser.add_argument(
+        '--port', type=int, default=SERVER_PORT,
+        help="server port, any server of a federation will do (default: %(default)s)"
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_console((args.host, args.port)))
+    except KeyboardInterrupt:
+        print("[CLIENT] Disconnecting...")
 
 
 if __name__ == '__main__':
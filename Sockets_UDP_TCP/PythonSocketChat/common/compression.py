@@ -0,0 +1,49 @@
+import zlib
+
+
+# Optional zlib compression. Over TCP it is negotiated in the handshake (see protocol.py), UDP and
+# multicast messages have no handshake and carry a marker instead:
+#   magic (2 bytes) | zlib stream
+# The magic can't start a UTF-8 text, so uncompressed messages pass through unchanged.
+CAPABILITY: str = 'zlib'
+MAGIC: bytes = b'\xfa\x03'
+# smaller payloads rarely shrink enough to pay for the zlib header
+THRESHOLD: int = 128
+LEVEL: int = 6
+
+
+def compress(data: bytes) -> bytes:
+    # None when compressing does not make it smaller
+    if len(data) < THRESHOLD:
+        return None
+    compressed = zlib.compress(data, LEVEL)
+    return compressed if len(compressed) < len(data) else None
+
+
+def decompress(data: bytes, max_size: int) -> bytes:
+    # a few KiB of zlib can inflate to gigabytes, so never more than max_size comes out
+    decompressor = zlib.decompressobj()
+    try:
+        result = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise ValueError(f"Corrupted compressed data: {e}")
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed data inflates beyond the {max_size} bytes limit.")
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed data.")
+    return result
+
+
+def pack_message(message: bytes) -> bytes:
+    compressed = compress(message)
+    return message if compressed is None else MAGIC + compressed
+
+
+def unpack_message(message: bytes, max_size: int) -> bytes:
+    # None for a corrupted message, it is dropped like a datagram that never arrived
+    if not message.startswith(MAGIC):
+        return message
+    try:
+        return decompress(message[len(MAGIC):], max_size)
+    except ValueError:
+        return None
@@ -0,0 +1,111 @@
+import math
+import random
+import struct
+import time
+from collections import OrderedDict
+
+
+# UDP and multicast messages are split into datagrams small enough to never be fragmented by IP:
+# magic (2 bytes) | sender id (4) | message id (4) | fragment index (2) | fragment count (2) | chunk
+# The sender id tells apart messages relayed by the server, they all come from the server's address.
+# The magic can't start a UTF-8 text, so plain datagrams ("UDP INIT", old clients) pass through.
+FRAGMENT_HEADER: struct.Struct = struct.Struct('!2sIIHH')
+MAGIC: bytes = b'\xfa\x01'
+MAX_DATAGRAM: int = 1200
+CHUNK_SIZE: int = MAX_DATAGRAM - FRAGMENT_HEADER.size
+MAX_MESSAGE_SIZE: int = 64 * 1024
+
+# a message missing a fragment for this long is given up, and all incomplete messages together
+# never hold more than MAX_PENDING_BYTES - the oldest one goes first
+REASSEMBLY_TIMEOUT: float = 5.0
+MAX_PENDING_BYTES: int = 4 * 1024 * 1024
+# late duplicates of these many recently completed messages are recognised and ignored
+RECENT_MESSAGES: int = 1024
+
+
+class Fragmenter:
+    def __init__(self, sender_id: int = None) -> None:
+        self.sender_id = random.getrandbits(32) if sender_id is None else sender_id
+        self.next_id = 0
+
+    def split(self, message: bytes) -> list:
+        if len(message) > MAX_MESSAGE_SIZE:
+            raise ValueError(f"Message of {len(message)} bytes exceeds the {MAX_MESSAGE_SIZE} bytes limit.")
+        message_id, self.next_id = self.next_id, (self.next_id + 1) & 0xFFFFFFFF
+        count = max(1, math.ceil(len(message) / CHUNK_SIZE))
+        return [
+            FRAGMENT_HEADER.pack(MAGIC, self.sender_id, message_id, index, count)
+            + message[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+            for index in range(count)
+        ]
+
+
+class PartialMessage:
+    def __init__(self, count: int, started: float) -> None:
+        self.chunks: list = [None] * count
+        self.missing = count
+        self.size = 0
+        self.started = started
+
+
+class Reassembler:
+    def __init__(
+            self, timeout: float = REASSEMBLY_TIMEOUT, max_pending_bytes: int = MAX_PENDING_BYTES,
+            max_message_size: int = MAX_MESSAGE_SIZE
+    ) -> None:
+        self.timeout = timeout
+        self.max_pending_bytes = max_pending_bytes
+        self.max_fragments = math.ceil(max_message_size / CHUNK_SIZE)
+        self.pending: OrderedDict = OrderedDict()  # (source, sender id, message id) -> PartialMessage, oldest first
+        self.size = 0
+        self.dropped = 0  # incomplete messages given up on
+        self.completed: OrderedDict = OrderedDict()  # keys of recently completed messages
+
+    def feed(self, data: bytes, source: tuple) -> bytes:
+        # returns the whole message once its last fragment arrives, None until then
+        if not data.startswith(MAGIC) or len(data) < FRAGMENT_HEADER.size:
+            return data
+        _, sender_id, message_id, index, count = FRAGMENT_HEADER.unpack_from(data)
+        if index >= count or count > self.max_fragments:
+            return None
+        chunk = data[FRAGMENT_HEADER.size:]
+        if count == 1:
+            return chunk
+
+        now = time.monotonic()
+        self.expire(now)
+        key = (source, sender_id, message_id)
+        if key in self.completed:
+            return None
+        partial = self.pending.get(key)
+        if partial is None:
+            partial = self.pending[key] = PartialMessage(count, now)
+        elif len(partial.chunks) != count:
+            return None
+        if partial.chunks[index] is not None:
+            return None  # duplicate
+
+        partial.chunks[index] = chunk
+        partial.missing -= 1
+        partial.size += len(chunk)
+        self.size += len(chunk)
+        if not partial.missing:
+            del self.pending[key]
+            self.size -= partial.size
+            self.completed[key] = None
+            if len(self.completed) > RECENT_MESSAGES:
+                self.completed.popitem(last=False)
+            return b''.join(partial.chunks)
+
+        while self.size > self.max_pending_bytes:
+            self.drop_oldest()
+        return None
+
+    def expire(self, now: float) -> None:
+        while self.pending and now - next(iter(self.pending.values())).started > self.timeout:
+            self.drop_oldest()
+
+    def drop_oldest(self) -> None:
+        _, partial = self.pending.popitem(last=False)
+        self.size -= partial.size
+        self.dropped += 1
@@ -0,0 +1,104 @@
+import struct
+from common import compression
+
+
+FORMAT: str = 'utf-8'
+
+# every TCP message is: payload length (4 bytes, big endian) | message type (1 byte) | payload
+HEADER: struct.Struct = struct.Struct('!IB')
+MAX_FRAME_SIZE: int = 1024 * 1024
+READ_CHUNK: int = 64 * 1024
+
+NICKNAME: int = 1    # payload: nickname [\0 room [\0 last seen sequence number [\0 capabilities]]]
+CHAT: int = 2
+SYSTEM: int = 3
+SHUTDOWN: int = 4
+PING: int = 5
+PONG: int = 6
+ROOM_JOIN: int = 7   # payload: room name [\0 last seen sequence number]
+ROOM_LEAVE: int = 8  # back to the lobby
+ROOM_LIST: int = 9
+MESSAGE: int = 10    # server -> client chat: sequence number in the room (8 bytes, big endian) | text
+CAPABILITIES: int = 11  # server -> client: the capabilities from the handshake the server accepted, comma separated
+COMPRESSED: int = 12    # payload: zlib of one or more whole frames, only after both sides agreed on 'zlib'
+
+SEQUENCE: struct.Struct = struct.Struct('!Q')
+
+# clients send a PING over TCP and repeat UDP INIT this often, the server drops silent clients
+HEARTBEAT_INTERVAL: float = 15.0
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(kind: int, payload: bytes = b'') -> bytes:
+    return HEADER.pack(len(payload), kind) + payload
+
+
+def encode_text(kind: int, text: str) -> bytes:
+    return encode_frame(kind, text.encode(FORMAT))
+
+
+def encode_message(seq: int, payload: bytes) -> bytes:
+    return encode_frame(MESSAGE, SEQUENCE.pack(seq) + payload)
+
+
+def decode_message(payload: bytes) -> tuple:
+    return SEQUENCE.unpack_from(payload)[0], payload[SEQUENCE.size:]
+
+
+def compress_frames(frames: bytes) -> bytes:
+    # one or more encoded frames, wrapped in a COMPRESSED frame if that makes them smaller
+    if len(frames) > MAX_FRAME_SIZE:
+        return frames
+    compressed = compression.compress(frames)
+    return frames if compressed is None else encode_frame(COMPRESSED, compressed)
+
+
+class FrameDecoder:
+    # Incremental decoder: bytes from the socket go in, whole (type, payload) frames come out.
+    # A read may end in the middle of a frame, the rest waits in the buffer for the next feed.
+    # COMPRESSED frames are unpacked here, the caller only ever sees the frames inside.
+    def __init__(self, max_size: int = MAX_FRAME_SIZE, compressed: bool = True) -> None:
+        self.max_size = max_size
+        self.compressed = compressed
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        end = len(buffer)
+
+        while end - offset >= HEADER.size:
+            length, kind = HEADER.unpack_from(buffer, offset)
+            if length > self.max_size:
+                raise ProtocolError(f"Frame of {length} bytes exceeds the {self.max_size} bytes limit.")
+            start = offset + HEADER.size
+            if end - start < length:
+                break
+            payload = bytes(buffer[start:start + length])
+            if kind == COMPRESSED:
+                frames.extend(self.unpack(payload))
+            else:
+                frames.append((kind, payload))
+            offset = start + length
+
+        if offset:
+            del buffer[:offset]
+        return frames
+
+    def unpack(self, payload: bytes) -> list:
+        if not self.compressed:
+            raise ProtocolError("Nested compressed frame.")
+        try:
+            data = compression.decompress(payload, self.max_size)
+        except ValueError as e:
+            raise ProtocolError(str(e))
+        inner = FrameDecoder(self.max_size, compressed=False)
+        frames = inner.feed(data)
+        if inner.buffer:
+            raise ProtocolError("Compressed frame ends in the middle of a frame.")
+        return frames
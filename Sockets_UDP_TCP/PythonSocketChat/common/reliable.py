@@ -0,0 +1,203 @@
+import random
+import struct
+from collections import deque
+
+
+# Reliable multicast, NACK based: every datagram a sender puts on the group gets the next number of
+# that sender. Receivers deliver each sender's datagrams in order, notice gaps and multicast a NACK
+# for what is missing, the sender resends it from a bounded buffer. Nobody acknowledges what
+# arrived, so the cost does not grow with the number of listeners.
+#   magic (2 bytes) | kind (1) | sender id (4) | sequence number (8) | payload
+# DATA carries a datagram (usually a fragment, see fragments.py), NACK asks the sender `sender id`
+# for `count` (2 bytes of payload) datagrams starting at the sequence number, HEARTBEAT carries the
+# sender's last sequence number so a lost tail is noticed too.
+RELIABLE_HEADER: struct.Struct = struct.Struct('!2sBIQ')
+NACK_COUNT: struct.Struct = struct.Struct('!H')
+MAGIC: bytes = b'\xfa\x02'
+DATA: int = 1
+NACK: int = 2
+HEARTBEAT: int = 3
+
+RETRANSMIT_BUFFER_BYTES: int = 1024 * 1024
+HEARTBEAT_INTERVAL: float = 0.5
+HEARTBEAT_IDLE: float = 10.0   # a sender stops heartbeating this long after its last datagram
+NACK_DELAY: float = 0.02       # plus jitter, a NACK from another receiver for the same gap resets it
+NACK_INTERVAL: float = 0.2
+MAX_NACKS: int = 10            # then the datagram counts as lost and delivery moves on
+POLL_INTERVAL: float = 0.02    # how often the owner should call poll()
+MAX_GAP: int = 4096            # a receiver further behind starts over from the newest datagram
+# a stream first seen this close to its start is recovered from its first datagram, the sender
+# surely still has it - otherwise a listener that lost the very first datagram would never see it
+RECOVER_FROM_START: int = 16
+SENDER_TIMEOUT: float = 60.0
+
+
+def is_reliable(packet: bytes) -> bool:
+    if not packet.startswith(MAGIC) or len(packet) < RELIABLE_HEADER.size:
+        return False
+    return packet[2] != NACK or len(packet) >= RELIABLE_HEADER.size + NACK_COUNT.size
+
+
+class ReliableSender:
+    def __init__(self, sender_id: int, max_bytes: int = RETRANSMIT_BUFFER_BYTES) -> None:
+        self.sender_id = sender_id
+        self.max_bytes = max_bytes
+        self.sent: deque = deque()  # [packet, last time it was sent] for first_seq, first_seq + 1, ...
+        self.first_seq = 0
+        self.next_seq = 0
+        self.size = 0
+        self.last_send = 0.0
+        self.next_heartbeat = 0.0
+        self.retransmitted = 0
+
+    def send(self, datagram: bytes, now: float) -> bytes:
+        packet = RELIABLE_HEADER.pack(MAGIC, DATA, self.sender_id, self.next_seq) + datagram
+        self.next_seq += 1
+        self.sent.append([packet, now])
+        self.size += len(packet)
+        while self.size > self.max_bytes:
+            self.size -= len(self.sent.popleft()[0])
+            self.first_seq += 1
+        self.last_send = now
+        self.next_heartbeat = now + HEARTBEAT_INTERVAL
+        return packet
+
+    def resend(self, start: int, count: int, now: float) -> list:
+        # several receivers may ask for the same datagram, it is resent once per NACK_INTERVAL
+        packets = []
+        for seq in range(max(start, self.first_seq), min(start + count, self.next_seq)):
+            entry = self.sent[seq - self.first_seq]
+            if now - entry[1] >= NACK_INTERVAL / 2:
+                entry[1] = now
+                packets.append(entry[0])
+        self.retransmitted += len(packets)
+        return packets
+
+    def heartbeat(self, now: float) -> bytes:
+        if not self.next_seq or now < self.next_heartbeat or now - self.last_send > HEARTBEAT_IDLE:
+            return None
+        self.next_heartbeat = now + HEARTBEAT_INTERVAL
+        return RELIABLE_HEADER.pack(MAGIC, HEARTBEAT, self.sender_id, self.next_seq - 1)
+
+
+class SenderState:
+    # what one receiver knows about one sender
+    def __init__(self, next_seq: int, now: float) -> None:
+        self.next_seq = next_seq     # the next datagram to deliver
+        self.highest = next_seq - 1  # the newest sequence number we know exists
+        self.buffer: dict = {}       # seq -> datagram that arrived out of order, None when given up
+        self.missing: dict = {}      # seq -> [time of the next NACK, NACKs sent]
+        self.last_heard = now
+
+
+class ReliableReceiver:
+    def __init__(self) -> None:
+        self.senders: dict = {}  # sender id -> SenderState
+        self.lost = 0
+
+    def receive(self, packet: bytes, now: float) -> list:
+        # returns the datagrams that are now deliverable, in order, as (sender id, datagram)
+        _, kind, sender_id, seq = RELIABLE_HEADER.unpack_from(packet)
+        if kind == NACK:
+            self.suppress(sender_id, seq, NACK_COUNT.unpack_from(packet, RELIABLE_HEADER.size)[0], now)
+            return []
+
+        state = self.senders.get(sender_id)
+        if state is None:
+            # joined in the middle of the stream, there is nothing to recover before this
+            start = 0 if seq < RECOVER_FROM_START else seq if kind == DATA else seq + 1
+            state = self.senders[sender_id] = SenderState(start, now)
+        state.last_heard = now
+        if seq - state.next_seq >= MAX_GAP:
+            self.lost += len(state.missing)
+            self.senders[sender_id] = state = SenderState(seq if kind == DATA else seq + 1, now)
+
+        if seq > state.highest:
+            for missing in range(state.highest + 1, seq if kind == DATA else seq + 1):
+                state.missing[missing] = [now + NACK_DELAY * (1 + random.random()), 0]
+            state.highest = seq
+        if kind != DATA or seq < state.next_seq or seq in state.buffer:
+            return []
+        state.missing.pop(seq, None)
+        state.buffer[seq] = packet[RELIABLE_HEADER.size:]
+        return self.deliver(sender_id, state)
+
+    def deliver(self, sender_id: int, state: SenderState) -> list:
+        ready = []
+        while state.next_seq in state.buffer:
+            datagram = state.buffer.pop(state.next_seq)
+            if datagram is not None:
+                ready.append((sender_id, datagram))
+            state.next_seq += 1
+        return ready
+
+    def suppress(self, sender_id: int, start: int, count: int, now: float) -> None:
+        # somebody else already asked for these, wait for the retransmission instead of asking too
+        state = self.senders.get(sender_id)
+        if state is None:
+            return
+        for seq in range(start, start + count):
+            entry = state.missing.get(seq)
+            if entry is not None:
+                entry[0] = max(entry[0], now + NACK_INTERVAL)
+
+    def poll(self, now: float) -> tuple:
+        # NACK packets due now, and datagrams that became deliverable because we gave up on a gap
+        nacks, ready = [], []
+        for sender_id, state in list(self.senders.items()):
+            if now - state.last_heard > SENDER_TIMEOUT:
+                self.lost += len(state.missing)
+                del self.senders[sender_id]
+                continue
+
+            due = []
+            for seq, entry in list(state.missing.items()):
+                if entry[0] > now:
+                    continue
+                if entry[1] >= MAX_NACKS:
+                    del state.missing[seq]
+                    state.buffer[seq] = None
+                    self.lost += 1
+                    continue
+                entry[0] = now + NACK_INTERVAL * (1 + random.random())
+                entry[1] += 1
+                due.append(seq)
+
+            due.sort()
+            start = None
+            for i, seq in enumerate(due):
+                if start is None:
+                    start = seq
+                if i + 1 == len(due) or due[i + 1] != seq + 1 or seq + 1 - start == 0xFFFF:
+                    nacks.append(
+                        RELIABLE_HEADER.pack(MAGIC, NACK, sender_id, start) + NACK_COUNT.pack(seq + 1 - start)
+                    )
+                    start = None
+            ready.extend(self.deliver(sender_id, state))
+        return nacks, ready
+
+
+# one multicast participant: its own stream as a sender plus everybody else's as a receiver
+class ReliableMulticast:
+    def __init__(self, sender_id: int) -> None:
+        self.sender = ReliableSender(sender_id)
+        self.receiver = ReliableReceiver()
+
+    def send(self, datagram: bytes, now: float) -> bytes:
+        return self.sender.send(datagram, now)
+
+    def receive(self, packet: bytes, now: float) -> tuple:
+        # (deliverable datagrams, packets to put on the group)
+        kind, sender_id, seq = RELIABLE_HEADER.unpack_from(packet)[1:]
+        if kind == NACK and sender_id == self.sender.sender_id:
+            count = NACK_COUNT.unpack_from(packet, RELIABLE_HEADER.size)[0]
+            return [], self.sender.resend(seq, count, now)
+        return self.receiver.receive(packet, now), []
+
+    def poll(self, now: float) -> tuple:
+        # (deliverable datagrams, packets to put on the group)
+        packets, ready = self.receiver.poll(now)
+        heartbeat = self.sender.heartbeat(now)
+        if heartbeat is not None:
+            packets.append(heartbeat)
+        return ready, packets
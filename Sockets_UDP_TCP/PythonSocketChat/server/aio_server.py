@@ -0,0 +1,142 @@
+import asyncio
+import hub
+import metrics
+from common import protocol
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+TCP_BACKLOG: int = 4096
+SHUTDOWN_TIMEOUT: float = 5.0
+
+writer_tasks: set = set()
+udp_transport: asyncio.DatagramTransport = None
+
+
+async def write_tcp(writer: asyncio.StreamWriter, session: hub.ClientSession, ready: asyncio.Event) -> None:
+    outbox = session.outbox
+    try:
+        while not outbox.done:
+            await ready.wait()
+            ready.clear()
+            data = b''.join(outbox.take())
+            writer.write(data)
+            hub.tcp_bytes_out.inc(len(data))
+            # backpressure stays local to this client, the rest of the room is not waiting
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def handle_tcp(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    address = writer.get_extra_info('peername')
+    decoder = protocol.FrameDecoder()
+    frames = []
+    try:
+        while not frames:
+            data = await reader.read(protocol.READ_CHUNK)
+            if not data:
+                break
+            frames = decoder.feed(data)
+    except (ConnectionError, protocol.ProtocolError):
+        pass
+
+    if not frames or frames[0][0] != protocol.NICKNAME:
+        writer.close()
+        return
+    nickname, room, since, capabilities = hub.split_fields(frames.pop(0)[1], 4)
+
+    ready = asyncio.Event()
+    session = hub.ClientSession(nickname, address, ready.set, writer.transport.abort)
+    writer_task = asyncio.create_task(write_tcp(writer, session, ready))
+    writer_tasks.add(writer_task)
+    writer_task.add_done_callback(writer_tasks.discard)
+    hub.join(session, room.strip(), hub.parse_seq(since), capabilities)
+
+    try:
+        while True:
+            for kind, payload in frames:
+                hub.handle_frame(session, kind, payload)
+            data = await reader.read(protocol.READ_CHUNK)
+            if not data:
+                break
+            hub.tcp_bytes_in.inc(len(data))
+            frames = decoder.feed(data)
+    except (ConnectionError, protocol.ProtocolError):
+        pass
+    finally:
+        hub.leave(session)
+
+
+class UdpChatProtocol(asyncio.DatagramProtocol):
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        global udp_transport
+        udp_transport = transport
+
+    def datagram_received(self, data: bytes, address: tuple) -> None:
+        hub.handle_udp(address, data, udp_transport.sendto)
+
+    def error_received(self, exc: Exception) -> None:
+        # ICMP port unreachable from a client that went away, nothing to do
+        pass
+
+
+async def reap_idle() -> None:
+    while True:
+        await asyncio.sleep(hub.idle_timers.tick)
+        hub.expire_idle()
+        metrics.tick()
+
+
+async def close_server() -> None:
+    hub.close_server()
+    if writer_tasks:
+        await asyncio.wait(list(writer_tasks), timeout=SHUTDOWN_TIMEOUT)
+
+
+def raise_fd_limit() -> None:
+    # every client is a file descriptor, the default soft limit (often 1024) is far too low
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+async def serve(addr: tuple, reuse_port: bool = False) -> None:
+    loop = asyncio.get_running_loop()
+    server = await asyncio.start_server(
+        handle_tcp, addr[0], addr[1], backlog=TCP_BACKLOG, reuse_port=reuse_port or None
+    )
+    transport, _ = await loop.create_datagram_endpoint(
+        UdpChatProtocol, local_addr=addr, reuse_port=reuse_port or None
+    )
+
+    reaper = asyncio.create_task(reap_idle())
+
+    print("[SERVER] Starting the server (asyncio)...")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        print("[SERVER] Shutting down the server...")
+        server.close()
+        reaper.cancel()
+        await close_server()
+        transport.close()
+
+
+def run(addr: tuple) -> None:
+    raise_fd_limit()
+    try:
+        asyncio.run(serve(addr))
+    except KeyboardInterrupt:
+        pass
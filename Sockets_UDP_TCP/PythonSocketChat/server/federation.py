@@ -0,0 +1,301 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+import aio_server
+import hub
+import metrics
+from common import protocol
+
+
+# Several servers linked over TCP into one chat: every server floods what happens to its clients
+# to all its links, and every server that sees an event for the first time applies it and passes
+# it on to its other links, so any connected topology works (a chain, a ring, a full mesh). Events
+# use the chat framing with their own types, the payload is
+#   origin node id \0 event id \0 body
+# An event whose (origin, event id) was already seen is dropped, that is what stops loops and the
+# duplicates a mesh delivers. Node ids are random, a restarted server is a new node to the others.
+FED_HELLO: int = 111    # first frame on a link, not flooded, body: node id of the sender
+FED_TCP: int = 112      # body: room \0 an encoded frame for the room's TCP clients
+FED_UDP: int = 113      # body: room \0 a datagram for the room's UDP clients
+FED_CHAT: int = 114     # body: room \0 sender's member id \0 chat text, every server numbers it itself
+FED_JOIN: int = 115     # body: change \0 member id \0 room \0 host:port \0 nickname
+FED_LEAVE: int = 116    # body: change \0 member id
+FED_ALIVE: int = 117    # body: number of the origin's last membership change
+FED_RESYNC: int = 118   # body: node id that should send its whole membership again
+FED_MEMBERS: int = 119  # body: change \0 FED_JOIN frames (without a change) of all the origin's members
+
+# Membership of every server is kept by all the others. Each server numbers the changes of its own
+# membership 1, 2, 3..., a change is applied only right after the previous one. A gap (a change
+# that got lost, or overtook another one on a different path) and a number the ALIVE heartbeat
+# announced but never arrived are repaired by asking the origin for its full list.
+ALIVE_INTERVAL: float = 5.0
+NODE_TIMEOUT: float = 3 * ALIVE_INTERVAL  # then its members are gone
+RESYNC_INTERVAL: float = 1.0              # answer at most this often, everybody may ask at once
+RECONNECT_INTERVAL: float = 2.0
+MAX_LINK_BUFFER: int = 8 * 1024 * 1024    # a peer this far behind is dropped and reconnects
+SEEN_EVENTS: int = 65536
+MAX_EVENT_SIZE: int = 16 * 1024 * 1024  # a full membership list of a big server
+
+events_in = metrics.Counter('chat_federation_events_in_total', "federation events received", rated=True)
+events_out = metrics.Counter('chat_federation_events_out_total', "federation events written to links", rated=True)
+duplicates = metrics.Counter('chat_federation_duplicates_total', "federation events dropped as already seen")
+resyncs = metrics.Counter('chat_federation_resyncs_total', "full membership lists asked for")
+
+
+class NodeState:
+    # what this server knows about another one
+    def __init__(self, now: float) -> None:
+        self.members: set = set()
+        self.applied = 0    # number of the last membership change applied
+        self.announced = 0  # what its previous ALIVE said the last change was
+        self.last_heard = now
+        self.last_resync = 0.0
+
+
+class Federation:
+    # hub.bus of a federated server
+    def __init__(self) -> None:
+        self.node_id = hub.node_id
+        self.links: dict = {}  # writer -> node id of the peer
+        self.event_ids = itertools.count()
+        self.seen: OrderedDict = OrderedDict()
+        self.nodes: dict = {}  # node id -> NodeState
+        self.change = 0  # number of our last membership change
+        self.last_members = 0.0
+
+    def see(self, key: tuple) -> bool:
+        if key in self.seen:
+            return False
+        self.seen[key] = None
+        if len(self.seen) > SEEN_EVENTS:
+            self.seen.popitem(last=False)
+        return True
+
+    def forward(self, source: asyncio.StreamWriter, frame: bytes) -> None:
+        for writer in list(self.links):
+            if writer is source or writer.is_closing():
+                continue
+            if writer.transport.get_write_buffer_size() > MAX_LINK_BUFFER:
+                print(f"[SERVER] Federation peer {self.links[writer]} is too slow, dropping the link.")
+                writer.transport.abort()
+                continue
+            writer.write(frame)
+            events_out.inc()
+
+    def publish(self, kind: int, body: bytes) -> None:
+        event_id = next(self.event_ids)
+        self.forward(None, protocol.encode_frame(kind, f'{self.node_id}\0{event_id}\0'.encode(protocol.FORMAT) + body))
+
+    # the interface hub.py expects from its bus
+    def tcp(self, room: str, frame: bytes) -> None:
+        self.publish(FED_TCP, room.encode(protocol.FORMAT) + b'\0' + frame)
+
+    def udp(self, room: str, message: bytes) -> None:
+        self.publish(FED_UDP, room.encode(protocol.FORMAT) + b'\0' + message)
+
+    def publish_change(self, kind: int, body: bytes) -> None:
+        self.change += 1
+        self.publish(kind, f'{self.change}\0'.encode(protocol.FORMAT) + body)
+
+    def join(self, member_id: str, room: str, address: tuple, nickname: str) -> None:
+        self.publish_change(FED_JOIN, join_body(member_id, room, address, nickname))
+
+    def leave(self, member_id: str) -> None:
+        self.publish_change(FED_LEAVE, member_id.encode(protocol.FORMAT))
+
+    def chat(self, room: str, member_id: str, text: bytes) -> None:
+        hub.deliver_chat(room, member_id, text)
+        self.publish(FED_CHAT, f'{room}\0{member_id}\0'.encode(protocol.FORMAT) + text)
+
+    def alive(self) -> None:
+        self.publish(FED_ALIVE, str(self.change).encode(protocol.FORMAT))
+
+    def send_members(self) -> None:
+        now = time.monotonic()
+        if now - self.last_members < RESYNC_INTERVAL:
+            return
+        self.last_members = now
+        body = b''.join(protocol.encode_frame(FED_JOIN, join_body(*member)) for member in hub.local_members())
+        self.publish_change(FED_MEMBERS, body)
+
+    def resync(self, origin: str, node: NodeState, now: float) -> None:
+        if now - node.last_resync >= RESYNC_INTERVAL:
+            node.last_resync = now
+            resyncs.inc()
+            self.publish(FED_RESYNC, origin.encode(protocol.FORMAT))
+
+    def receive(self, source: asyncio.StreamWriter, kind: int, payload: bytes) -> None:
+        events_in.inc()
+        origin, event_id, body = payload.split(b'\0', 2)
+        origin, event_id = origin.decode(protocol.FORMAT), int(event_id)
+        if origin == self.node_id or not self.see((origin, event_id)):
+            duplicates.inc()
+            return
+        self.forward(source, protocol.encode_frame(kind, payload))
+
+        now = time.monotonic()
+        node = self.nodes.get(origin)
+        if node is None:
+            node = self.nodes[origin] = NodeState(now)
+            print(f"[SERVER] Federation node {origin} is up.")
+        node.last_heard = now
+
+        if kind == FED_TCP:
+            room, frame = body.split(b'\0', 1)
+            hub.deliver_tcp(room.decode(protocol.FORMAT), None, frame)
+        elif kind == FED_UDP and aio_server.udp_transport is not None:
+            room, message = body.split(b'\0', 1)
+            hub.deliver_udp(room.decode(protocol.FORMAT), message, aio_server.udp_transport.sendto)
+        elif kind == FED_CHAT:
+            room, sender_id, text = body.split(b'\0', 2)
+            hub.deliver_chat(room.decode(protocol.FORMAT), sender_id.decode(protocol.FORMAT), text)
+        elif kind in (FED_JOIN, FED_LEAVE, FED_MEMBERS):
+            change, body = body.split(b'\0', 1)
+            change = int(change)
+            if change <= node.applied:
+                return  # older than what we have, a full list overtook it
+            if kind == FED_MEMBERS or change == node.applied + 1:
+                node.applied = change
+                self.apply(node, kind, body)
+            else:
+                self.resync(origin, node, now)
+        elif kind == FED_ALIVE:
+            change = int(body)
+            # still behind what the previous ALIVE announced, or never heard of its members at all
+            if node.applied < node.announced or (change and not node.applied):
+                self.resync(origin, node, now)
+            node.announced = change
+        elif kind == FED_RESYNC and body.decode(protocol.FORMAT) == self.node_id:
+            self.send_members()
+
+    def apply(self, node: NodeState, kind: int, body: bytes) -> None:
+        if kind == FED_JOIN:
+            member_id, room, address, nickname = parse_join(body)
+            node.members.add(member_id)
+            hub.remote_join(member_id, room, address, nickname)
+        elif kind == FED_LEAVE:
+            member_id = body.decode(protocol.FORMAT)
+            node.members.discard(member_id)
+            hub.remote_leave(member_id)
+        else:
+            members = [parse_join(join) for _, join in protocol.FrameDecoder(compressed=False).feed(body)]
+            current = {member[0] for member in members}
+            for member_id in node.members - current:
+                hub.remote_leave(member_id)
+            for member in members:
+                hub.remote_join(*member)
+            node.members = current
+
+    def expire(self) -> None:
+        now = time.monotonic()
+        for origin, node in list(self.nodes.items()):
+            if now - node.last_heard > NODE_TIMEOUT:
+                print(f"[SERVER] Federation node {origin} timed out, {len(node.members)} member(s) gone.")
+                del self.nodes[origin]
+                for member_id in node.members:
+                    hub.remote_leave(member_id)
+
+
+def join_body(member_id: str, room: str, address: tuple, nickname: str) -> bytes:
+    host, port = address
+    return f'{member_id}\0{room}\0{host}:{port}\0{nickname}'.encode(protocol.FORMAT)
+
+
+def parse_join(body: bytes) -> tuple:
+    member_id, room, address, nickname = body.decode(protocol.FORMAT).split('\0', 3)
+    host, port = address.rsplit(':', 1)
+    return member_id, room, (host, int(port)), nickname
+
+
+async def run_link(federation: Federation, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    writer.write(protocol.encode_frame(FED_HELLO, federation.node_id.encode(protocol.FORMAT)))
+    decoder = protocol.FrameDecoder(max_size=MAX_EVENT_SIZE, compressed=False)
+    peer = None
+    try:
+        while True:
+            data = await reader.read(protocol.READ_CHUNK)
+            if not data:
+                break
+            for kind, payload in decoder.feed(data):
+                if peer is not None:
+                    federation.receive(writer, kind, payload)
+                    continue
+                peer = payload.decode(protocol.FORMAT) if kind == FED_HELLO else None
+                if peer is None or peer == federation.node_id:
+                    return  # not a federation peer, or a link to ourselves
+                print(f"[SERVER] Federation link to {peer} up.")
+                federation.links[writer] = peer
+                # lets the peer (and everybody behind it) check our membership straight away
+                federation.alive()
+    except (ConnectionError, ValueError, protocol.ProtocolError):
+        pass
+    finally:
+        if federation.links.pop(writer, None) is not None:
+            print(f"[SERVER] Federation link to {peer} down.")
+        writer.close()
+
+
+async def dial(federation: Federation, peer: tuple) -> None:
+    # a configured peer is redialled for as long as the server runs
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(*peer)
+        except OSError:
+            await asyncio.sleep(RECONNECT_INTERVAL)
+            continue
+        await run_link(federation, reader, writer)
+        await asyncio.sleep(RECONNECT_INTERVAL)
+
+
+async def heartbeat(federation: Federation) -> None:
+    while True:
+        await asyncio.sleep(ALIVE_INTERVAL)
+        federation.alive()
+        federation.expire()
+
+
+async def serve_node(addr: tuple, federation_addr: tuple, peers: list) -> None:
+    federation = Federation()
+    hub.bus = federation
+    metrics.Gauge('chat_federation_links', "links to other federated servers", lambda: len(federation.links))
+    metrics.Gauge('chat_federation_nodes', "other federated servers heard from recently", lambda: len(federation.nodes))
+    tasks = [asyncio.create_task(heartbeat(federation))]
+    tasks += [asyncio.create_task(dial(federation, peer)) for peer in peers]
+    accepted: set = set()  # tasks of the links peers opened to us
+
+    async def accept_link(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        accepted.add(task)
+        try:
+            await run_link(federation, reader, writer)
+        except asyncio.CancelledError:
+            pass  # shutting down; asyncio logs a traceback for a server handler that ends cancelled
+        finally:
+            accepted.discard(task)
+
+    server = None
+    if federation_addr is not None:
+        server = await asyncio.start_server(accept_link, *federation_addr)
+        print(f"[SERVER] Federation node {federation.node_id} on {federation_addr[0]}:{federation_addr[1]}.")
+    try:
+        await aio_server.serve(addr)
+    finally:
+        if server is not None:
+            server.close()
+        # the accepted links too, they would otherwise be left for asyncio.run to cancel
+        tasks += accepted
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for writer in list(federation.links):
+            writer.close()
+
+
+def run(addr: tuple, federation_addr: tuple, peers: list) -> None:
+    aio_server.raise_fd_limit()
+    try:
+        asyncio.run(serve_node(addr, federation_addr, peers))
+    except KeyboardInterrupt:
+        pass
+
@@ -0,0 +1,36 @@
+import itertools
+from collections import deque
+
+
+# Recent chat of one room: a ring buffer of already encoded MESSAGE frames, the same bytes
+# objects that went to the clients' outboxes. It is bounded by a byte budget, the oldest
+# frames fall out first. Sequence numbers are consecutive, so frames[i] has first_seq + i.
+class History:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.frames: deque = deque()
+        self.size: int = 0
+        self.last_seq: int = 0
+
+    @property
+    def first_seq(self) -> int:
+        return self.last_seq - len(self.frames) + 1
+
+    def append(self, seq: int, frame: bytes) -> None:
+        if seq != self.last_seq + 1:
+            # the numbering restarted (the room was recreated) or we came in late, the old frames don't line up
+            self.frames.clear()
+            self.size = 0
+        self.frames.append(frame)
+        self.size += len(frame)
+        self.last_seq = seq
+        while self.size > self.max_bytes:
+            self.size -= len(self.frames.popleft())
+
+    def since(self, seq: int = None) -> tuple:
+        # frames newer than `seq` and how many of them are already gone, None means everything we have
+        if seq is None or seq > self.last_seq:
+            return list(self.frames), 0
+        first = self.first_seq
+        missed = max(0, first - 1 - seq)
+        return list(itertools.islice(self.frames, max(0, seq - first + 1), None)), missed
@@ -0,0 +1,479 @@
+import itertools
+import os
+import time
+from typing import Callable
+import metrics
+from common import compression, protocol
+from history import History
+from outbox import Outbox, DROP_OLDEST
+from timers import TimerWheel
+
+
+# slow consumer handling, overridden from the command line
+outbox_policy: str = DROP_OLDEST
+outbox_max_frames: int = 256
+outbox_max_bytes: int = 256 * 1024
+
+# a TCP client that sent nothing (not even a heartbeat) and a UDP address that sent nothing
+# (not even a repeated UDP INIT) for this long is dropped
+idle_timeout: float = 3 * protocol.HEARTBEAT_INTERVAL
+UDP_INIT: bytes = "UDP INIT".encode(protocol.FORMAT)
+PONG_FRAME: bytes = protocol.encode_frame(protocol.PONG)
+
+# everybody starts in the lobby, other rooms (and their history) exist only while somebody is in them
+DEFAULT_ROOM: str = 'lobby'
+MAX_ROOM_NAME: int = 32
+# replayed to a joining client in one write, so keep it below outbox_max_bytes
+history_max_bytes: int = 64 * 1024
+# offered to clients that ask for it in the handshake
+compression_enabled: bool = True
+
+connected_clients: set = set()
+rooms: dict = {}                # name -> Room
+sessions_by_address: dict = {}  # the client binds its UDP socket to its TCP address, so UDP follows its room
+udp_clients: dict = {}          # address -> last time we heard from it
+udp_rooms: dict = {}            # address -> Room
+connection_lock: metrics.TimedLock = metrics.TimedLock('chat_connection_lock')
+idle_timers: TimerWheel = TimerWheel(tick=1.0, slots=64)
+
+# set by sharding.py when this process is one of several workers sharing the port, or by
+# federation.py when it is linked to other servers: everything broadcast here is also published to
+# the other workers/servers, `remote_members` are their clients
+bus = None
+remote_members: dict = {}    # member id -> (Room, address)
+remote_addresses: dict = {}  # address -> member id, with SO_REUSEPORT a client's UDP may land on another worker
+# member ids are unique across processes and servers: this process' id, a dash and a counter
+node_id: str = os.urandom(4).hex()
+member_ids = itertools.count()
+
+# the engines count the bytes, the hub everything else
+tcp_connections = metrics.Counter('chat_tcp_connections_total', "TCP clients that joined")
+tcp_messages_in = metrics.Counter('chat_tcp_messages_in_total', "frames received from TCP clients", rated=True)
+tcp_messages_out = metrics.Counter('chat_tcp_messages_out_total', "frames queued for TCP clients", rated=True)
+tcp_bytes_in = metrics.Counter('chat_tcp_bytes_in_total', "bytes received from TCP clients", rated=True)
+tcp_bytes_out = metrics.Counter('chat_tcp_bytes_out_total', "bytes written to TCP clients", rated=True)
+udp_messages_in = metrics.Counter('chat_udp_messages_in_total', "datagrams received", rated=True)
+udp_messages_out = metrics.Counter('chat_udp_messages_out_total', "datagrams sent", rated=True)
+udp_bytes_in = metrics.Counter('chat_udp_bytes_in_total', "bytes of datagrams received", rated=True)
+udp_bytes_out = metrics.Counter('chat_udp_bytes_out_total', "bytes of datagrams sent", rated=True)
+slow_disconnects = metrics.Counter('chat_slow_disconnects_total', "clients disconnected for reading too slowly")
+idle_disconnects = metrics.Counter('chat_idle_disconnects_total', "TCP and UDP clients dropped for silence")
+fanout_time = metrics.Histogram(
+    'chat_fanout_seconds', "time to queue one broadcast for every recipient in the room", metrics.LATENCY_BUCKETS
+)
+fanout_size = metrics.Histogram('chat_fanout_recipients', "recipients of one broadcast", metrics.SIZE_BUCKETS)
+compressed_frames = metrics.Counter('chat_compressed_frames_total', "frames compressed for TCP clients")
+compression_saved = metrics.Counter(
+    'chat_compression_saved_bytes_total', "bytes not queued for TCP clients thanks to compression", rated=True
+)
+dropped_by_gone_clients: int = 0
+
+
+class Room:
+    # a broadcast only walks the members of its own room, not every connected client
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.members: set = set()
+        self.remote_members: dict = {}  # member id -> nickname
+        self.udp_clients: set = set()
+        self.history = History(history_max_bytes)
+
+    def size(self) -> int:
+        return len(self.members) + len(self.remote_members)
+
+    def is_empty(self) -> bool:
+        return not (self.members or self.remote_members or self.udp_clients)
+
+
+class ClientSession:
+    def __init__(
+            self, nickname: str, address: tuple, wakeup: Callable[[], None], disconnect: Callable[[], None]
+    ) -> None:
+        self.nickname = nickname
+        self.address = address
+        self.disconnect = disconnect
+        self.room = None
+        self.last_seen = time.monotonic()
+        self.member_id = f'{node_id}-{next(member_ids)}'
+        self.compress = False  # agreed on in the handshake
+        self.outbox = Outbox(outbox_max_frames, outbox_max_bytes, outbox_policy, wakeup, self.too_slow)
+
+    def send(self, frames: bytes) -> None:
+        # a frame (or several) for this client only, broadcasts compress once for the whole room instead
+        if self.compress:
+            frames = compress(frames, 1)
+        self.outbox.put(frames)
+
+    def too_slow(self) -> None:
+        slow_disconnects.inc()
+        print(f"[SERVER] {self.nickname} {self.address} is too slow, disconnecting.")
+        self.disconnect()
+
+
+def system_frame(text: str) -> bytes:
+    return protocol.encode_text(protocol.SYSTEM, text)
+
+
+def compress(frames: bytes, recipients: int) -> bytes:
+    compressed = protocol.compress_frames(frames)
+    if compressed is not frames:
+        compressed_frames.inc()
+        compression_saved.inc((len(frames) - len(compressed)) * recipients)
+    return compressed
+
+
+def negotiate(session: ClientSession, requested: str) -> None:
+    # the client learns what we agreed to, an old client asks for nothing and gets no answer
+    wanted = {name.strip() for name in requested.split(',') if name.strip()}
+    if not wanted:
+        return
+    accepted = []
+    if compression_enabled and compression.CAPABILITY in wanted:
+        session.compress = True
+        accepted.append(compression.CAPABILITY)
+    session.outbox.put(protocol.encode_text(protocol.CAPABILITIES, ','.join(accepted)))
+
+
+# the room index helpers below expect connection_lock to be held
+def get_room(name: str) -> Room:
+    room = rooms.get(name)
+    if room is None:
+        room = rooms[name] = Room(name)
+    return room
+
+
+def drop_if_empty(room: Room) -> None:
+    if room.is_empty() and room.name != DEFAULT_ROOM and rooms.get(room.name) is room:
+        del rooms[room.name]
+
+
+def room_of(address: tuple) -> Room:
+    session = sessions_by_address.get(address)
+    if session is not None:
+        return session.room
+    member_id = remote_addresses.get(address)
+    if member_id is not None:
+        return remote_members[member_id][0]
+    return get_room(DEFAULT_ROOM)
+
+
+def move_udp(address: tuple, old: Room, new: Room) -> None:
+    if udp_rooms.get(address) is old:
+        old.udp_clients.discard(address)
+        new.udp_clients.add(address)
+        udp_rooms[address] = new
+
+
+def split_fields(payload: bytes, count: int) -> list:
+    # NICKNAME is "nickname [\0 room [\0 seq [\0 capabilities]]]", ROOM_JOIN is "room [\0 seq]", missing fields are ''
+    fields = payload.decode(protocol.FORMAT, errors='replace').split('\0', count - 1)
+    return fields + [''] * (count - len(fields))
+
+
+def parse_seq(text: str) -> int:
+    return int(text) if text.isdigit() else None
+
+
+def valid_room(name: str) -> bool:
+    return 0 < len(name) <= MAX_ROOM_NAME
+
+
+def join(session: ClientSession, room: str = DEFAULT_ROOM, since: int = None, capabilities: str = '') -> None:
+    negotiate(session, capabilities)
+    with connection_lock:
+        connected_clients.add(session)
+        sessions_by_address[session.address] = session
+    idle_timers.schedule(session, idle_timeout)
+    tcp_connections.inc()
+
+    print(f"[SERVER] Connected with {session.nickname} {session.address}")
+    room = room if valid_room(room) else DEFAULT_ROOM
+    enter_room(session, room, f"[{session.nickname}] Joined the chat.", since)
+
+
+def enter_room(session: ClientSession, name: str, announcement: str, since: int = None) -> None:
+    with connection_lock:
+        old, new = session.room, get_room(name)
+        if old is new:
+            return
+        people_in_the_room = f"[CLIENT] Chatroom {name}: "
+        for c in new.members:
+            people_in_the_room += f'({c.nickname}) '
+        for nickname in new.remote_members.values():
+            people_in_the_room += f'({nickname}) '
+
+        # queued under the lock, so no live message can overtake the replay
+        session.send(system_frame(people_in_the_room))
+        replay, missed = new.history.since(since)
+        if missed:
+            session.outbox.put(system_frame(f"[SERVER] {missed} older message(s) are no longer in the history."))
+        if replay:
+            session.send(b''.join(replay))
+        new.members.add(session)
+        session.room = new
+        # on a first join too: a UDP INIT that arrived before it was filed under the lobby
+        udp_room = udp_rooms.get(session.address)
+        if udp_room is not None:
+            move_udp(session.address, udp_room, new)
+            drop_if_empty(udp_room)
+        if old is not None:
+            old.members.discard(session)
+            drop_if_empty(old)
+
+    if bus is not None:
+        bus.join(session.member_id, name, session.address, session.nickname)
+    if old is not None:
+        broadcast_tcp(old.name, session, system_frame(f"[{session.nickname}] Left the room."))
+    broadcast_tcp(name, session, system_frame(announcement))
+
+
+def leave(session: ClientSession) -> None:
+    global dropped_by_gone_clients
+    with connection_lock:
+        if session not in connected_clients:
+            return
+        dropped_by_gone_clients += session.outbox.dropped
+        connected_clients.remove(session)
+        if sessions_by_address.get(session.address) is session:
+            del sessions_by_address[session.address]
+        room = session.room
+        room.members.discard(session)
+        drop_if_empty(room)
+    idle_timers.cancel(session)
+    if bus is not None:
+        bus.leave(session.member_id)
+
+    print(f"[SERVER] {session.nickname} {session.address} disconnected.")
+    broadcast_tcp(room.name, session, system_frame(f"[{session.nickname}] Left the chat."))
+    session.outbox.close()
+
+
+def list_rooms() -> str:
+    with connection_lock:
+        listing = ', '.join(f'{room.name} ({room.size()})' for room in rooms.values() if room.size())
+    return f"[SERVER] Rooms: {listing}"
+
+
+def handle_frame(session: ClientSession, kind: int, payload: bytes) -> None:
+    # no rescheduling here, the timer just finds a fresh last_seen when it fires
+    session.last_seen = time.monotonic()
+    tcp_messages_in.inc()
+    if kind == protocol.CHAT:
+        broadcast_chat(session, payload)
+    elif kind == protocol.PING:
+        session.outbox.put(PONG_FRAME)
+    elif kind == protocol.ROOM_JOIN:
+        name, since = split_fields(payload, 2)
+        name = name.strip()
+        if not valid_room(name):
+            session.outbox.put(system_frame(f"[SERVER] A room name has 1 to {MAX_ROOM_NAME} characters."))
+        else:
+            enter_room(session, name, f"[{session.nickname}] Joined the room.", parse_seq(since))
+    elif kind == protocol.ROOM_LEAVE:
+        enter_room(session, DEFAULT_ROOM, f"[{session.nickname}] Joined the room.")
+    elif kind == protocol.ROOM_LIST:
+        session.send(system_frame(list_rooms()))
+
+
+def broadcast_chat(session: ClientSession, payload: bytes) -> None:
+    if bus is not None:
+        # the relay numbers the message and sends it back to every worker, this one included
+        bus.chat(session.room.name, session.member_id, payload)
+        return
+    deliver_chat(session.room.name, session.member_id, payload)
+
+
+def deliver_chat(room: str, sender_id: str, payload: bytes) -> None:
+    # numbered by this process, a federated server keeps its own numbering of the same messages
+    with connection_lock:
+        target = rooms.get(room)
+        if target is None:
+            return
+        seq = target.history.last_seq + 1
+    deliver_message(room, sender_id, seq, protocol.encode_message(seq, payload))
+
+
+def deliver_message(room: str, sender_id: str, seq: int, frame: bytes) -> None:
+    # the frame is encoded once and the same bytes go to the history and to every outbox
+    start = time.perf_counter()
+    with connection_lock:
+        target = rooms.get(room)
+        if target is None:
+            return
+        target.history.append(seq, frame)
+        recipients = [c for c in target.members if c.member_id != sender_id]
+
+    put_all(recipients, frame)
+    record_fanout(start, len(recipients), tcp_messages_out)
+
+
+def broadcast_tcp(room: str, sender: ClientSession, frame: bytes) -> None:
+    # the frame is encoded once by the caller, lock only for the snapshot - a slow recipient never blocks the room
+    if bus is not None:
+        bus.tcp(room, frame)
+    deliver_tcp(room, sender, frame)
+
+
+def deliver_tcp(room: str, sender: ClientSession, frame: bytes) -> None:
+    start = time.perf_counter()
+    with connection_lock:
+        target = rooms.get(room)
+        recipients = [c for c in target.members if c is not sender] if target is not None else []
+
+    put_all(recipients, frame)
+    record_fanout(start, len(recipients), tcp_messages_out)
+
+
+def put_all(recipients: list, frame: bytes) -> None:
+    # the compressed frame is built once per broadcast and shared by every client that agreed to it
+    compressing = sum(c.compress for c in recipients)
+    compressed = compress(frame, compressing) if compressing else frame
+    for c in recipients:
+        c.outbox.put(compressed if c.compress else frame)
+
+
+def record_fanout(start: float, recipients: int, sent: metrics.Counter) -> None:
+    fanout_time.observe(time.perf_counter() - start)
+    fanout_size.observe(recipients)
+    sent.inc(recipients)
+
+
+def handle_udp(address: tuple, message: bytes, sendto: Callable[[bytes, tuple], None]) -> None:
+    now = time.monotonic()
+    udp_messages_in.inc()
+    udp_bytes_in.inc(len(message))
+    with connection_lock:
+        known = address in udp_clients
+        if known:
+            udp_clients[address] = now
+            room = udp_rooms[address]
+        else:
+            room = room_of(address)
+            if message == UDP_INIT:
+                udp_clients[address] = now
+                udp_rooms[address] = room
+                room.udp_clients.add(address)
+            else:
+                drop_if_empty(room)
+
+    if message == UDP_INIT:
+        # clients repeat UDP INIT as their heartbeat, only a new registration is worth a log line
+        if not known:
+            print("[SERVER] UDP INIT")
+            idle_timers.schedule(address, idle_timeout)
+        return
+
+    print("[SERVER] UDP message.")
+    if bus is not None:
+        bus.udp(room.name, message)
+    deliver_udp(room.name, message, sendto)
+
+
+def deliver_udp(room: str, message: bytes, sendto: Callable[[bytes, tuple], None]) -> None:
+    start = time.perf_counter()
+    with connection_lock:
+        target = rooms.get(room)
+        recipients = list(target.udp_clients) if target is not None else []
+
+    for cl in recipients:
+        sendto(message, cl)
+    record_fanout(start, len(recipients), udp_messages_out)
+    udp_bytes_out.inc(len(message) * len(recipients))
+
+
+def remote_join(member_id: str, room: str, address: tuple, nickname: str) -> None:
+    # a member of another worker switching rooms joins again under the same id
+    with connection_lock:
+        old, _ = remote_members.get(member_id, (None, None))
+        new = get_room(room)
+        new.remote_members[member_id] = nickname
+        remote_members[member_id] = (new, address)
+        remote_addresses[address] = member_id
+        # on a first join too: a UDP INIT that reached this worker before the join was filed under the lobby
+        udp_room = udp_rooms.get(address)
+        if udp_room is not None and udp_room is not new:
+            move_udp(address, udp_room, new)
+            drop_if_empty(udp_room)
+        if old is not None and old is not new:
+            del old.remote_members[member_id]
+            drop_if_empty(old)
+
+
+def remote_leave(member_id: str) -> None:
+    with connection_lock:
+        room, address = remote_members.pop(member_id, (None, None))
+        if room is not None:
+            del room.remote_members[member_id]
+            drop_if_empty(room)
+            remote_addresses.pop(address, None)
+
+
+def expire_idle() -> None:
+    now = time.monotonic()
+    for key in idle_timers.advance(now):
+        if isinstance(key, ClientSession):
+            remaining = key.last_seen + idle_timeout - now
+            if remaining > 0:
+                idle_timers.schedule(key, remaining)
+            else:
+                print(f"[SERVER] {key.nickname} {key.address} timed out.")
+                idle_disconnects.inc()
+                key.disconnect()
+            continue
+
+        with connection_lock:
+            last_seen = udp_clients.get(key)
+            remaining = 0.0 if last_seen is None else last_seen + idle_timeout - now
+            if last_seen is not None and remaining <= 0:
+                del udp_clients[key]
+                room = udp_rooms.pop(key)
+                room.udp_clients.discard(key)
+                drop_if_empty(room)
+        if remaining > 0:
+            idle_timers.schedule(key, remaining)
+        elif last_seen is not None:
+            print(f"[SERVER] UDP client {key} timed out.")
+            idle_disconnects.inc()
+
+
+def close_server() -> None:
+    shutdown = protocol.encode_frame(protocol.SHUTDOWN)
+    with connection_lock:
+        sessions = list(connected_clients)
+        connected_clients.clear()
+        sessions_by_address.clear()
+        udp_clients.clear()
+        udp_rooms.clear()
+        rooms.clear()
+        for session in sessions:
+            idle_timers.cancel(session)
+
+    for session in sessions:
+        session.outbox.close(shutdown)
+
+
+def local_members() -> list:
+    # (member id, room, address, nickname) of this process' own TCP clients
+    with connection_lock:
+        return [(c.member_id, c.room.name, c.address, c.nickname) for c in connected_clients if c.room is not None]
+
+
+def outbox_depths() -> list:
+    with connection_lock:
+        sessions = list(connected_clients)
+    return [len(session.outbox.frames) for session in sessions]
+
+
+def outbox_dropped() -> int:
+    with connection_lock:
+        return dropped_by_gone_clients + sum(session.outbox.dropped for session in connected_clients)
+
+
+metrics.Gauge('chat_tcp_clients', "connected TCP clients", lambda: len(connected_clients))
+metrics.Gauge('chat_udp_clients', "registered UDP addresses", lambda: len(udp_clients))
+metrics.Gauge('chat_rooms', "rooms with at least one member", lambda: len(rooms))
+metrics.Gauge('chat_outbox_frames', "frames queued for all TCP clients", lambda: sum(outbox_depths()))
+metrics.Gauge(
+    'chat_outbox_frames_max', "frames queued for the most backed up TCP client", lambda: max(outbox_depths(), default=0)
+)
+metrics.Gauge('chat_outbox_dropped', "frames dropped or coalesced for slow clients", outbox_dropped)
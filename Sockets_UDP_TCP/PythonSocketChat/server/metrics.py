@@ -0,0 +1,151 @@
+import bisect
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+
+# Counters and histograms cheap enough for the hot path: an increment is an attribute update, no
+# lock (in the threaded mode two threads may rarely lose an increment, that is the price). Gauges are
+# computed only when somebody reads the stats. Everything is rendered in the Prometheus text format.
+registry: list = []
+RATE_WINDOW: int = 10  # seconds the *_per_second gauges are averaged over
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, rated: bool = False) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        # for rated counters tick() keeps one sample per second to report a per second rate
+        self.samples: deque = deque(maxlen=RATE_WINDOW + 1) if rated else None
+        registry.append(self)
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def rate(self) -> float:
+        if len(self.samples) < 2:
+            return 0.0
+        (start, first), (end, last) = self.samples[0], self.samples[-1]
+        return (last - first) / (end - start) if end > start else 0.0
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter', f'{self.name} {self.value}']
+        if self.samples is not None:
+            rate_name = self.name.removesuffix('_total') + '_per_second'
+            lines += [
+                f'# HELP {rate_name} {self.help_text}, per second over the last {RATE_WINDOW} s',
+                f'# TYPE {rate_name} gauge', f'{rate_name} {self.rate():.2f}',
+            ]
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help_text: str, read: Callable[[], float]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        registry.append(self)
+
+    def render(self) -> list:
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge', f'{self.name} {self.read()}']
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, bounds: tuple) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.bounds = bounds
+        self.counts: list = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        registry.append(self)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines += [
+            f'{self.name}_bucket{{le="+Inf"}} {self.count}',
+            f'{self.name}_sum {round(self.sum, 6)}', f'{self.name}_count {self.count}',
+        ]
+        return lines
+
+
+# seconds, 10 us .. 1 s
+LATENCY_BUCKETS: tuple = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 0.1, 1.0)
+SIZE_BUCKETS: tuple = (0, 1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+class TimedLock:
+    # a threading.Lock that records how long acquiring it had to wait, the uncontended path only
+    # costs a non-blocking acquire and an increment
+    def __init__(self, name: str) -> None:
+        self.lock = threading.Lock()
+        self.acquired = Counter(f'{name}_acquired_total', f"acquisitions of {name}")
+        self.contended = Counter(f'{name}_contended_total', f"acquisitions of {name} that had to wait")
+        self.wait = Histogram(f'{name}_wait_seconds', f"time spent waiting for {name} when contended", LATENCY_BUCKETS)
+
+    def __enter__(self) -> None:
+        self.acquired.value += 1
+        if not self.lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.contended.value += 1
+            self.wait.observe(time.perf_counter() - start)
+
+    def __exit__(self, *exc) -> None:
+        self.lock.release()
+
+
+started: float = time.monotonic()
+Gauge('chat_uptime_seconds', "seconds since the server started", lambda: round(time.monotonic() - started, 1))
+
+
+def tick() -> None:
+    # called once a second by the engine's timer
+    now = time.monotonic()
+    for metric in registry:
+        if isinstance(metric, Counter) and metric.samples is not None:
+            metric.samples.append((now, metric.value))
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def serve(addr: tuple) -> None:
+    # its own thread in every mode, a scrape never waits for the chat
+    try:
+        server = ThreadingHTTPServer(addr, StatsHandler)
+    except OSError as e:
+        print(f"[SERVER] Stats endpoint not started on {addr[0]}:{addr[1]}: {e}")
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='stats').start()
+    print(f"[SERVER] Stats on http://{addr[0]}:{addr[1]}/")
@@ -0,0 +1,93 @@
+import threading
+from collections import deque
+from typing import Callable
+from common import protocol
+
+
+# what happens when a client reads slower than the room writes
+DROP_OLDEST: str = 'drop-oldest'
+DISCONNECT: str = 'disconnect'
+COALESCE: str = 'coalesce'
+SLOW_CLIENT_POLICIES: tuple = (DROP_OLDEST, DISCONNECT, COALESCE)
+
+
+def skipped_notice(count: int) -> bytes:
+    return protocol.encode_text(protocol.SYSTEM, f"[SERVER] You are reading too slowly, {count} message(s) skipped.")
+
+
+# Bounded queue of already encoded frames waiting for one client's writer. Broadcasting only
+# appends to it and calls `wakeup`, the (possibly slow) socket writes happen in the writer
+# owned by the connection. With the DISCONNECT policy `on_overflow` is called once, it has to
+# tear the connection down even if the writer is stuck in a blocking send.
+class Outbox:
+    def __init__(
+            self, max_frames: int, max_bytes: int, policy: str,
+            wakeup: Callable[[], None], on_overflow: Callable[[], None]
+    ) -> None:
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.wakeup = wakeup
+        self.on_overflow = on_overflow
+        self.frames: deque = deque()
+        self.size: int = 0
+        self.skipped: int = 0
+        self.dropped: int = 0
+        self.closed: bool = False
+        self.overflowed: bool = False
+        self.lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self.overflowed or (self.closed and not self.frames)
+
+    def put(self, frame: bytes) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            if len(self.frames) >= self.max_frames or self.size + len(frame) > self.max_bytes:
+                if self.policy == DISCONNECT:
+                    self.overflowed = True
+                    self.closed = True
+                    self.frames.clear()
+                    self.size = 0
+                elif self.policy == COALESCE:
+                    self.skipped += len(self.frames)
+                    self.dropped += len(self.frames)
+                    self.frames.clear()
+                    self.size = 0
+                else:
+                    while self.frames and (
+                            len(self.frames) >= self.max_frames or self.size + len(frame) > self.max_bytes
+                    ):
+                        self.size -= len(self.frames.popleft())
+                        self.dropped += 1
+
+            if not self.overflowed:
+                self.frames.append(frame)
+                self.size += len(frame)
+
+        if self.overflowed:
+            self.on_overflow()
+        self.wakeup()
+
+    def take(self) -> list:
+        with self.lock:
+            frames = list(self.frames)
+            self.frames.clear()
+            self.size = 0
+            if self.skipped:
+                frames.insert(0, skipped_notice(self.skipped))
+                self.skipped = 0
+        return frames
+
+    def close(self, last_frame: bytes = None) -> None:
+        # last_frame bypasses the limits, it is used for the shutdown notice
+        with self.lock:
+            if self.closed:
+                return
+            if last_frame is not None:
+                self.frames.append(last_frame)
+                self.size += len(last_frame)
+            self.closed = True
+        self.wakeup()
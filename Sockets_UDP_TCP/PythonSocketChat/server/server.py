@@ -1,82 +1,115 @@
+import argparse
+import os
 import socket
+import sys
 import threading
+import time
 import select
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aio_server
+import federation
+import hub
+import metrics
+import sharding
+from common import protocol
+from outbox import SLOW_CLIENT_POLICIES
+
 FORMAT: str = 'utf-8'
 SERVER_IP: str = '127.0.0.1'
 SERVER_PORT: int = 12345
 ADDR: tuple = (SERVER_IP, SERVER_PORT)
-
-connected_clients: set = set()
-udp_clients: set = set()
-connection_lock: threading.Lock = threading.Lock()
+STATS_PORT: int = 12347
 
 server_tcp: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 server_udp: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
 
-def broadcast_tcp(client: tuple, message: str) -> None:
-    with connection_lock:
-        for c in connected_clients:
-            if c != client:
-                c[1].send(message.encode(FORMAT))
+def shutdown_socket(client: socket.socket) -> None:
+    try:
+        client.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
 
 
-def handle_tcp(client: socket.socket, address: tuple) -> None:
-    nickname = client.recv(1024).decode(FORMAT)
-    new_client = (nickname, client, address)
-    people_in_the_room = "[CLIENT] Chatroom: "
-    with connection_lock:
-        for nick, _, __ in connected_clients:
-            people_in_the_room += f'({nick}) '
-        connected_clients.add(new_client)
-    
-    print(f"[SERVER] Connected with {nickname} {address}")
-    broadcast_tcp(new_client, f"[{nickname}] Joined the chat.")
-    client.send(people_in_the_room.encode(FORMAT))
+def write_tcp(client: socket.socket, session: hub.ClientSession, ready: threading.Event) -> None:
+    outbox = session.outbox
+    try:
+        while not outbox.done:
+            ready.wait()
+            ready.clear()
+            # everything queued since the last wakeup goes out in a single syscall
+            data = b''.join(outbox.take())
+            client.sendall(data)
+            hub.tcp_bytes_out.inc(len(data))
+    except OSError:
+        pass
 
-    while True:
-        try:
-            message = client.recv(1024).decode(FORMAT)
-            broadcast_tcp(new_client, message)
-        except ConnectionResetError:
-            with connection_lock:
-                connected_clients.remove(new_client)
-            
-            print(f"[SERVER] {nickname} {address} disconnected.")
-            broadcast_tcp(new_client, f"[{nickname}] Left the chat.")
-            break
-        except ConnectionAbortedError:
-            break 
+    # wakes up the reading thread if the connection is being dropped from our side
+    shutdown_socket(client)
+
+
+def handle_tcp(client: socket.socket, address: tuple) -> None:
+    decoder = protocol.FrameDecoder()
+    frames = []
+    try:
+        while not frames:
+            data = client.recv(protocol.READ_CHUNK)
+            if not data:
+                break
+            frames = decoder.feed(data)
+    except (OSError, protocol.ProtocolError):
+        pass
+
+    if not frames or frames[0][0] != protocol.NICKNAME:
+        client.close()
+        return
+    nickname, room, since, capabilities = hub.split_fields(frames.pop(0)[1], 4)
+
+    ready = threading.Event()
+    session = hub.ClientSession(nickname, address, ready.set, lambda: shutdown_socket(client))
+    writer_thread = threading.Thread(target=write_tcp, args=(client, session, ready), daemon=True)
+    writer_thread.start()
+    hub.join(session, room.strip(), hub.parse_seq(since), capabilities)
+
+    try:
+        while True:
+            # frames that came together with the nickname are handled first
+            for kind, payload in frames:
+                hub.handle_frame(session, kind, payload)
+            data = client.recv(protocol.READ_CHUNK)
+            if not data:
+                break
+            hub.tcp_bytes_in.inc(len(data))
+            frames = decoder.feed(data)
+    except (OSError, protocol.ProtocolError):
+        pass
+
+    hub.leave(session)
+    writer_thread.join()
+    client.close()
 
 
 def handle_udp(client: tuple, message: bytes):
-    if message.decode(FORMAT) == "UDP INIT":
-        print("[SERVER] UDP INIT")
-        udp_clients.add(client)
-    else:
-        print("[SERVER] UDP message.")
-        with connection_lock:
-            for cl in udp_clients:
-                server_udp.sendto(message, cl)
+    hub.handle_udp(client, message, server_udp.sendto)
 
 
-def close_server() -> None:
-    with connection_lock:
-        for client in connected_clients:
-            client[1].send("#SERVER SHUTDOWN#".encode(FORMAT))
-            client[1].close()
-        
-    connected_clients.clear()
-    udp_clients.clear()
+def reap_idle() -> None:
+    # one thread ticks the timer wheel for every client, no per client timers
+    while True:
+        time.sleep(hub.idle_timers.tick)
+        hub.expire_idle()
+        metrics.tick()
 
 
-def main() -> None:
+def run_threads() -> None:
     server_tcp.bind(ADDR)
     server_tcp.listen()
     server_udp.bind(ADDR)
 
     sockets = [server_tcp, server_udp]
+    threading.Thread(target=reap_idle, daemon=True).start()
 
     print("[SERVER] Starting the server...")
     while True:
@@ -90,18 +123,108 @@ def main() -> None:
                     tcp_thread.start()  
 
                 elif sock == server_udp:
-                    data, address = server_udp.recvfrom(1024)
+                    data, address = server_udp.recvfrom(65535)
                     udp_thread = threading.Thread(target=handle_udp, args=(address, data))
                     udp_thread.start()
         except KeyboardInterrupt:
             print("[SERVER] Shutting down the server...")
-            close_server()
+            hub.close_server()
             break
     
     server_tcp.close()
     server_udp.close()
 
 
+def main() -> None:
+    global ADDR
+    parser = argparse.ArgumentParser(description="TCP/UDP chat server.")
+    parser.add_argument(
+        '--mode', choices=['asyncio', 'threads'], default='asyncio',
+        help="asyncio: single event loop for all clients (default), threads: legacy thread per connection"
+    )
+    parser.add_argument(
+        '--slow-client', choices=SLOW_CLIENT_POLICIES, default=hub.outbox_policy,
+        help="what to do when a client's outbound queue is full (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--queue-size', type=int, default=hub.outbox_max_frames,
+        help="maximum number of messages queued for one client (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--idle-timeout', type=float, default=hub.idle_timeout,
+        help="seconds of silence after which a TCP or UDP client is dropped (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--history-size', type=int, default=hub.history_max_bytes,
+        help="bytes of recent messages kept per room and replayed on join, 0 disables it (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--no-compression', action='store_true',
+        help="never agree to compress TCP traffic, even for clients that ask for it"
+    )
+    parser.add_argument(
+        '--stats-port', type=int, default=STATS_PORT,
+        help="port of the HTTP stats endpoint on 127.0.0.1, 0 disables it; with --workers worker i uses port + i "
+             "(default: %(default)s)"
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help="number of asyncio worker processes sharing the port (SO_REUSEPORT), default: %(default)s"
+    )
+    parser.add_argument(
+        '--host', default=SERVER_IP,
+        help="address the chat and the federation port listen on, e.g. 0.0.0.0 to link servers on other "
+             "machines (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--port', type=int, default=SERVER_PORT, help="TCP and UDP port of the chat (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--federation-port', type=int, default=0,
+        help="port other servers link to for federation, 0: only link to the --peer servers (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--peer', action='append', default=[], metavar='HOST:PORT',
+        help="federation port of another server to link to, may be given several times"
+    )
+    args = parser.parse_args()
+    federated = bool(args.federation_port or args.peer)
+    if federated and (args.mode == 'threads' or args.workers > 1):
+        parser.error("federation runs on a single asyncio process, without --mode threads and --workers")
+    try:
+        peers = [(host, int(port)) for host, port in (peer.rsplit(':', 1) for peer in args.peer)]
+    except ValueError:
+        parser.error("--peer takes HOST:PORT")
+    # the history is replayed to a joining client in one write, which has to fit in its outbox
+    if not 0 <= args.history_size <= hub.outbox_max_bytes:
+        parser.error(f"--history-size takes 0 to {hub.outbox_max_bytes} bytes, the outbox limit")
+
+    hub.outbox_policy = args.slow_client
+    hub.outbox_max_frames = args.queue_size
+    hub.idle_timeout = args.idle_timeout
+    hub.history_max_bytes = args.history_size
+    hub.compression_enabled = not args.no_compression
+
+    if args.stats_port and (args.mode == 'threads' or args.workers <= 1):
+        metrics.serve((SERVER_IP, args.stats_port))
+
+    ADDR = (args.host, args.port)
+    if args.mode == 'threads':
+        run_threads()
+    elif federated:
+        federation.run(ADDR, (args.host, args.federation_port) if args.federation_port else None, peers)
+    elif args.workers > 1:
+        settings = {
+            'outbox_policy': hub.outbox_policy,
+            'outbox_max_frames': hub.outbox_max_frames,
+            'idle_timeout': hub.idle_timeout,
+            'history_max_bytes': hub.history_max_bytes,
+            'compression_enabled': hub.compression_enabled,
+        }
+        sharding.run(ADDR, args.workers, settings, args.stats_port)
+    else:
+        aio_server.run(ADDR)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,224 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+import aio_server
+import hub
+import metrics
+from common import protocol
+
+
+# Messages on the bus between the workers and the relay in the parent process. They use the same
+# framing as the chat itself, only with their own message types.
+BUS_TCP: int = 101     # payload: room \0 an encoded chat frame to deliver to local TCP clients
+BUS_UDP: int = 102     # payload: room \0 a datagram to deliver to local UDP clients
+BUS_JOIN: int = 103    # payload: member id \0 room \0 host:port \0 nickname, sent again on a room change
+BUS_LEAVE: int = 104   # payload: member id
+BUS_CHAT: int = 105    # worker -> relay, payload: room \0 sender's member id \0 chat text
+BUS_MESSAGE: int = 106  # relay -> every worker, payload: room \0 sender's member id \0 encoded MESSAGE frame
+
+WORKER_STOP_TIMEOUT: float = 5.0
+
+
+class WorkerBus:
+    # hub.bus inside a worker: publishes local events to the relay
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+
+    def publish(self, kind: int, payload: bytes) -> None:
+        if not self.writer.is_closing():
+            self.writer.write(protocol.encode_frame(kind, payload))
+
+    def tcp(self, room: str, frame: bytes) -> None:
+        self.publish(BUS_TCP, room.encode(protocol.FORMAT) + b'\0' + frame)
+
+    def udp(self, room: str, message: bytes) -> None:
+        self.publish(BUS_UDP, room.encode(protocol.FORMAT) + b'\0' + message)
+
+    def join(self, member_id: str, room: str, address: tuple, nickname: str) -> None:
+        host, port = address
+        self.publish(BUS_JOIN, f'{member_id}\0{room}\0{host}:{port}\0{nickname}'.encode(protocol.FORMAT))
+
+    def leave(self, member_id: str) -> None:
+        self.publish(BUS_LEAVE, member_id.encode(protocol.FORMAT))
+
+    def chat(self, room: str, member_id: str, text: bytes) -> None:
+        self.publish(BUS_CHAT, f'{room}\0{member_id}\0'.encode(protocol.FORMAT) + text)
+
+
+async def listen_bus(reader: asyncio.StreamReader) -> None:
+    # events from the other workers, delivered only locally so they never bounce back to the bus
+    decoder = protocol.FrameDecoder(max_size=2 * protocol.MAX_FRAME_SIZE)
+    while True:
+        data = await reader.read(protocol.READ_CHUNK)
+        if not data:
+            print("[SERVER] Lost the connection to the worker bus.")
+            return
+        for kind, payload in decoder.feed(data):
+            if kind == BUS_TCP:
+                room, frame = payload.split(b'\0', 1)
+                hub.deliver_tcp(room.decode(protocol.FORMAT), None, frame)
+            elif kind == BUS_UDP and aio_server.udp_transport is not None:
+                room, message = payload.split(b'\0', 1)
+                hub.deliver_udp(room.decode(protocol.FORMAT), message, aio_server.udp_transport.sendto)
+            elif kind == BUS_JOIN:
+                member_id, room, address, nickname = payload.decode(protocol.FORMAT).split('\0', 3)
+                host, port = address.rsplit(':', 1)
+                hub.remote_join(member_id, room, (host, int(port)), nickname)
+            elif kind == BUS_LEAVE:
+                hub.remote_leave(payload.decode(protocol.FORMAT))
+            elif kind == BUS_MESSAGE:
+                room, sender_id, frame = payload.split(b'\0', 2)
+                seq = protocol.SEQUENCE.unpack_from(frame, protocol.HEADER.size)[0]
+                hub.deliver_message(room.decode(protocol.FORMAT), sender_id.decode(protocol.FORMAT), seq, frame)
+
+
+async def serve_worker(addr: tuple, bus_path: str) -> None:
+    # the parent asks for a graceful shutdown with SIGTERM, cancelling runs serve()'s cleanup
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    reader, writer = await asyncio.open_unix_connection(bus_path)
+    hub.bus = WorkerBus(writer)
+    listener = asyncio.create_task(listen_bus(reader))
+    try:
+        await aio_server.serve(addr, reuse_port=True)
+    finally:
+        listener.cancel()
+        writer.close()
+
+
+def run_worker(addr: tuple, bus_path: str, settings: dict, stats_port: int) -> None:
+    # with the spawn start method nothing set up by main() is inherited
+    for name, value in settings.items():
+        setattr(hub, name, value)
+    if stats_port:
+        metrics.serve((addr[0], stats_port))
+    # Ctrl+C in the terminal hits the whole process group, only the parent reacts to it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    aio_server.raise_fd_limit()
+    try:
+        asyncio.run(serve_worker(addr, bus_path))
+    except asyncio.CancelledError:
+        pass
+
+
+# The relay lives in the parent process: every worker connects to it over a Unix socket and
+# whatever one worker publishes is forwarded to all the others. It also keeps the membership of
+# the whole server, so a worker that (re)connects gets the full list and members of a worker
+# that died are removed everywhere. Chat messages are numbered here, so every worker keeps the
+# same history with the same sequence numbers.
+members: dict = {}       # member id -> BUS_JOIN payload
+worker_links: dict = {}  # writer -> member ids of that worker
+room_sizes: dict = {}    # room -> number of members
+room_seqs: dict = {}     # room -> last sequence number
+
+
+def relay(sender: asyncio.StreamWriter, frame: bytes) -> None:
+    for writer in worker_links:
+        if writer is not sender:
+            writer.write(frame)
+
+
+def room_of(join_payload: bytes) -> bytes:
+    return join_payload.split(b'\0', 2)[1]
+
+
+def track_member(member_id: bytes, payload: bytes = None) -> None:
+    # payload None means the member left, a room nobody is in starts its numbering again
+    old = members.pop(member_id, None)
+    if old is not None:
+        room = room_of(old)
+        room_sizes[room] -= 1
+        if not room_sizes[room]:
+            del room_sizes[room]
+            if room != hub.DEFAULT_ROOM.encode(protocol.FORMAT):
+                room_seqs.pop(room, None)
+    if payload is not None:
+        members[member_id] = payload
+        room = room_of(payload)
+        room_sizes[room] = room_sizes.get(room, 0) + 1
+
+
+def number_message(payload: bytes) -> bytes:
+    room, sender_id, text = payload.split(b'\0', 2)
+    seq = room_seqs[room] = room_seqs.get(room, 0) + 1
+    return protocol.encode_frame(BUS_MESSAGE, room + b'\0' + sender_id + b'\0' + protocol.encode_message(seq, text))
+
+
+async def handle_worker(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    owned = set()
+    worker_links[writer] = owned
+    writer.writelines([protocol.encode_frame(BUS_JOIN, payload) for payload in members.values()])
+
+    decoder = protocol.FrameDecoder(max_size=2 * protocol.MAX_FRAME_SIZE)
+    try:
+        while True:
+            data = await reader.read(protocol.READ_CHUNK)
+            if not data:
+                break
+            for kind, payload in decoder.feed(data):
+                if kind == BUS_CHAT:
+                    relay(None, number_message(payload))
+                    continue
+                if kind == BUS_JOIN:
+                    member_id = payload.split(b'\0', 1)[0]
+                    track_member(member_id, payload)
+                    owned.add(member_id)
+                elif kind == BUS_LEAVE:
+                    track_member(payload)
+                    owned.discard(payload)
+                relay(writer, protocol.encode_frame(kind, payload))
+    except ConnectionError:
+        pass
+    finally:
+        del worker_links[writer]
+        for member_id in owned:
+            track_member(member_id)
+            relay(writer, protocol.encode_frame(BUS_LEAVE, member_id))
+        writer.close()
+
+
+async def serve_relay(addr: tuple, workers: int, settings: dict, stats_port: int) -> None:
+    bus_path = os.path.join(tempfile.gettempdir(), f'chat-bus-{os.getpid()}.sock')
+    relay_server = await asyncio.start_unix_server(handle_worker, bus_path)
+
+    # spawn, not fork: a forked child would inherit this process' running event loop
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(
+            target=run_worker, args=(addr, bus_path, settings, stats_port and stats_port + i), name=f'chat-worker-{i}'
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    print(f"[SERVER] Started {workers} workers sharing {addr[0]}:{addr[1]}.")
+
+    try:
+        async with relay_server:
+            await relay_server.serve_forever()
+    finally:
+        # each worker sends the shutdown notice to its own clients
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            await asyncio.to_thread(process.join, WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+        # let the handlers see the workers' EOF instead of being cancelled mid-read
+        for _ in range(20):
+            if not worker_links:
+                break
+            await asyncio.sleep(0.05)
+        if os.path.exists(bus_path):
+            os.unlink(bus_path)
+
+
+def run(addr: tuple, workers: int, settings: dict, stats_port: int = 0) -> None:
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        raise SystemExit("[SERVER] --workers needs SO_REUSEPORT and Unix sockets (Linux, BSD, macOS).")
+    try:
+        asyncio.run(serve_relay(addr, workers, settings, stats_port))
+    except KeyboardInterrupt:
+        pass
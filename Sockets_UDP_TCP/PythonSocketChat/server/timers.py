@@ -0,0 +1,56 @@
+import math
+import threading
+import time
+
+
+# Hashed timing wheel: `slots` buckets, each covering `tick` seconds. Scheduling and cancelling
+# are O(1), advancing the clock only looks at the buckets that passed. Timers further away than
+# one turn of the wheel carry a number of remaining rounds.
+class TimerWheel:
+    def __init__(self, tick: float = 1.0, slots: int = 64) -> None:
+        self.tick = tick
+        self.slots: list = [{} for _ in range(slots)]
+        self.position: dict = {}
+        self.current: int = 0
+        self.last_tick: float = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.position)
+
+    def schedule(self, key, delay: float) -> None:
+        ticks = max(1, math.ceil(delay / self.tick))
+        rounds, offset = divmod(ticks, len(self.slots))
+        if offset == 0:
+            rounds, offset = rounds - 1, len(self.slots)
+
+        with self.lock:
+            old = self.position.get(key)
+            if old is not None:
+                del self.slots[old][key]
+            index = (self.current + offset) % len(self.slots)
+            self.slots[index][key] = rounds
+            self.position[key] = index
+
+    def cancel(self, key) -> None:
+        with self.lock:
+            index = self.position.pop(key, None)
+            if index is not None:
+                del self.slots[index][key]
+
+    def advance(self, now: float = None) -> list:
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self.lock:
+            while now - self.last_tick >= self.tick:
+                self.last_tick += self.tick
+                self.current = (self.current + 1) % len(self.slots)
+                slot = self.slots[self.current]
+                for key, rounds in list(slot.items()):
+                    if rounds == 0:
+                        del slot[key]
+                        del self.position[key]
+                        expired.append(key)
+                    else:
+                        slot[key] = rounds - 1
+        return expired